@@ -0,0 +1,194 @@
+__author__ = 'Mohammed Hamdy'
+
+# cross subject analytics over the stats_<subject>.csv files.
+# usage: python -m lib.analytics [--stats-dir config] [--block-size 20]
+
+import argparse, csv, glob, io, os
+from datetime import datetime
+from os.path import dirname, join, basename, splitext
+import numpy
+
+_config_dir = join(dirname(dirname(__file__)), "config")
+
+# columns kept from each stats file, by header name. missing columns (older files) are filled with nan
+_float_columns = {"trial_index": "Trial Index", "pellets": "Pellets Dispensed", "background_touches": "Background Touches",
+                  "video_touches": "Video Touches", "choice_time": "Time till Choice (sec)"}
+_cache_version = 1
+
+def _parse_timestamp(date, time):
+  # TrialData writes 24 hour times with an AM/PM suffix, so the suffix is ignored
+  try:
+    return datetime.strptime(date + " " + time.split(' ')[0], "%m-%d-%y %H:%M:%S").timestamp()
+  except ValueError:
+    return numpy.nan
+
+def _parse_float(value):
+  try:
+    return float(value)
+  except ValueError:
+    return numpy.nan
+
+class StatsFileCache(object):
+  """
+  Parsed columns of one stats file, cached next to the stats files in `.analytics_cache'.
+    The cache is keyed by the file's size and mtime. When the file only grew, just the appended rows are parsed.
+  """
+
+  def __init__(self, stats_path, cache_dir):
+    self._stats_path = stats_path
+    self._cache_path = join(cache_dir, splitext(basename(stats_path))[0] + ".npz")
+
+  def load(self):
+    stat = os.stat(self._stats_path)
+    cached = self._read_cache()
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+      return cached["columns"]
+    with open(self._stats_path, 'rb') as stats_file:
+      header_line = stats_file.readline()
+      header = next(csv.reader([header_line.decode()]))
+      # only a file that grew is parsed from where the cache stopped. a rewritten one (same or smaller size, or a
+      # header rewritten with more columns) is parsed again from the start
+      if cached is not None and cached["size"] < stat.st_size and cached["header"] == header:
+        stats_file.seek(cached["parsed_bytes"])
+        columns, parsed_bytes = cached["columns"], cached["parsed_bytes"]
+      else:
+        columns, parsed_bytes = None, len(header_line)
+      data = stats_file.read()
+    # rows still being written have no line end yet. they're parsed next time
+    data = data[:data.rfind(b"\n") + 1]
+    new_columns = self._parse_rows(header, data.decode())
+    if columns is not None:
+      new_columns = dict((name, numpy.concatenate([columns[name], new_columns[name]])) for name in columns)
+    self._write_cache(header, new_columns, parsed_bytes + len(data), stat)
+    return new_columns
+
+  def _parse_rows(self, header, text):
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    positions = dict((name, index) for index, name in enumerate(header))
+
+    def column(name):
+      index = positions.get(name)
+      return [row[index] if index is not None and index < len(row) else "" for row in rows]
+
+    columns = dict((key, numpy.array([_parse_float(value) for value in column(name)], dtype=numpy.float64))
+                   for key, name in _float_columns.items())
+    columns["timestamp"] = numpy.array([_parse_timestamp(date, time) for date, time in zip(column("Date"), column("Time"))],
+                                       dtype=numpy.float64)
+    columns["risky"] = numpy.array([card == "Risky" for card in column("Card Selected")], dtype=bool)
+    columns["condition"] = numpy.array(column("Condition"), dtype=str)
+    return columns
+
+  def _read_cache(self):
+    try:
+      with numpy.load(self._cache_path, allow_pickle=False) as cache:
+        if int(cache["_version"]) != _cache_version: return None
+        return {"size": int(cache["_size"]), "mtime": float(cache["_mtime"]), "parsed_bytes": int(cache["_parsed_bytes"]),
+                "header": list(cache["_header"]),
+                "columns": dict((name, cache[name]) for name in cache.files if not name.startswith("_"))}
+    except (IOError, KeyError, ValueError):
+      return None
+
+  def _write_cache(self, header, columns, parsed_bytes, stat):
+    os.makedirs(dirname(self._cache_path), exist_ok=True)
+    temp_path = self._cache_path + ".tmp.npz"
+    numpy.savez(temp_path, _version=_cache_version, _size=stat.st_size, _mtime=stat.st_mtime,
+                _parsed_bytes=parsed_bytes, _header=numpy.array(header, dtype=str), **columns)
+    os.replace(temp_path, self._cache_path)
+
+class StatsTable(object):
+  """
+  The trials of every subject as numpy column arrays.
+    `subject' and `condition' are integer codes into `subject_names' and `condition_names'.
+  """
+
+  def __init__(self, per_subject_columns):
+    self.subject_names = sorted(per_subject_columns)
+    self.condition_names = numpy.array([], dtype=str)
+    self.columns = {}
+    if not per_subject_columns:
+      return
+    names = list(per_subject_columns[self.subject_names[0]])
+    for name in names:
+      self.columns[name] = numpy.concatenate([per_subject_columns[subject][name] for subject in self.subject_names])
+    self.columns["subject"] = numpy.concatenate([numpy.full(len(per_subject_columns[subject]["risky"]), index)
+                                                 for index, subject in enumerate(self.subject_names)])
+    self.condition_names, self.columns["condition"] = numpy.unique(self.columns["condition"], return_inverse=True)
+
+  def __len__(self):
+    return len(self.columns.get("risky", ()))
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+def load_stats(stats_dir=_config_dir):
+  per_subject_columns = {}
+  cache_dir = join(stats_dir, ".analytics_cache")
+  for stats_path in sorted(glob.glob(join(stats_dir, "stats_*.csv"))):
+    subject = splitext(basename(stats_path))[0][len("stats_"):]
+    per_subject_columns[subject] = StatsFileCache(stats_path, cache_dir).load()
+  return StatsTable(per_subject_columns)
+
+def _group(*keys):
+  # returns (unique key rows, group index of every trial)
+  groups, inverse = numpy.unique(numpy.stack(keys, axis=1), axis=0, return_inverse=True)
+  return groups, inverse.ravel()
+
+def choice_ratio_per_block(table, block_size=20):
+  # risky choice ratio per subject, condition and block of `block_size' trials
+  block = ((table["trial_index"] - 1) // block_size).astype(numpy.int64)
+  groups, inverse = _group(table["subject"], table["condition"], block)
+  counts = numpy.bincount(inverse)
+  risky = numpy.bincount(inverse, weights=table["risky"])
+  return groups, counts, risky / counts
+
+def choice_time_stats(table, percentiles=(50, 90)):
+  # mean and percentiles of the choice time per subject and condition, ignoring trials without a time
+  valid = ~numpy.isnan(table["choice_time"])
+  groups, inverse = _group(table["subject"][valid], table["condition"][valid])
+  times = table["choice_time"][valid]
+  counts = numpy.bincount(inverse)
+  means = numpy.bincount(inverse, weights=times) / counts
+  # sorting by group then time puts every group's times in order, so percentiles are index lookups
+  order = numpy.lexsort((times, inverse))
+  sorted_times = times[order]
+  starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+  result = {"mean": means}
+  for percentile in percentiles:
+    positions = starts + numpy.floor((counts - 1) * percentile / 100.).astype(numpy.int64)
+    result["p{}".format(percentile)] = sorted_times[positions]
+  return groups, counts, result
+
+def totals_per_condition(table):
+  # pellets and touches summed per subject and condition
+  groups, inverse = _group(table["subject"], table["condition"])
+  totals = dict((name, numpy.bincount(inverse, weights=numpy.nan_to_num(table[name])))
+                for name in ("pellets", "background_touches", "video_touches"))
+  return groups, numpy.bincount(inverse), totals
+
+def _print_report(table, block_size):
+  subject_names, condition_names = table.subject_names, table.condition_names
+  print("{} trials of {} subjects".format(len(table), len(subject_names)))
+  if len(table) == 0: return
+  print("\nrisky choice ratio per block of {} trials".format(block_size))
+  groups, counts, ratios = choice_ratio_per_block(table, block_size)
+  for (subject, condition, block), count, ratio in zip(groups, counts, ratios):
+    print("  {:<16}{:<16}trials {:>4}-{:<4}{:>6.2f}  ({} trials)".format(
+      subject_names[subject], condition_names[condition], block * block_size + 1, (block + 1) * block_size, ratio, count))
+  print("\nchoice time (sec)")
+  groups, counts, stats = choice_time_stats(table)
+  for index, (subject, condition) in enumerate(groups):
+    print("  {:<16}{:<16}mean {:>6.2f}  median {:>6.2f}  p90 {:>6.2f}".format(
+      subject_names[subject], condition_names[condition], stats["mean"][index], stats["p50"][index], stats["p90"][index]))
+  print("\ntotals per condition")
+  groups, counts, totals = totals_per_condition(table)
+  for index, (subject, condition) in enumerate(groups):
+    print("  {:<16}{:<16}{:>4} trials  {:>6.0f} pellets  {:>6.0f} background / {:>6.0f} video touches".format(
+      subject_names[subject], condition_names[condition], counts[index], totals["pellets"][index],
+      totals["background_touches"][index], totals["video_touches"][index]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Aggregate PriMate stats files")
+  parser.add_argument("--stats-dir", default=_config_dir)
+  parser.add_argument("--block-size", type=int, default=20)
+  args = parser.parse_args()
+  _print_report(load_stats(args.stats_dir), args.block_size)
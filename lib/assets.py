@@ -0,0 +1,205 @@
+__author__ = 'Mohammed Hamdy'
+
+# transcodes condition videos and card images to the display resolution, once, with ffmpeg.
+# usage: python -m lib.assets --width 1920 --height 1080
+# run it before a session, after adding or changing videos. lib.booths runs it for its booths' window sizes before
+# starting them. PriMateApp only runs it, with --background, when the cache lacks something for its window
+#
+# prepared files are kept in config/.asset_cache, named after the hash of the original's content and the resolution,
+# so a renamed or copied asset isn't transcoded twice and a changed one is. manifest.json maps originals and resolutions
+# to them, so booths with different window sizes share the cache
+
+import argparse, hashlib, json, os, shutil, subprocess
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname, join, abspath, exists, splitext, getsize, getmtime
+from lib.util import get_video_dir, get_trial_image_paths
+
+_config_dir = join(dirname(dirname(abspath(__file__))), "config")
+
+video_extensions = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".mpg")
+
+def file_hash(path):
+  content_hash = hashlib.sha1()
+  with open(path, 'rb') as asset_reader:
+    for chunk in iter(lambda: asset_reader.read(1 << 20), b""):
+      content_hash.update(chunk)
+  return content_hash.hexdigest()
+
+def _ffmpeg_arguments(ffmpeg, source, target, width, height, threads=None):
+  # fit inside the display without ever upscaling
+  scale = "scale='min(iw,{0})':'min(ih,{1})':force_original_aspect_ratio=decrease".format(width, height)
+  # ffmpeg uses every core by default
+  thread_arguments = ["-threads", str(threads)] if threads else []
+  if splitext(source)[1].lower() in video_extensions:
+    # h264 in yuv420p decodes in hardware nearly everywhere. frequent key frames keep looping back to the start cheap,
+    # and the index goes first so the video opens without reading to the end
+    return [ffmpeg, "-y", "-loglevel", "error", "-i", source,
+            "-vf", scale + ",pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", "libx264", "-profile:v", "main",
+            "-pix_fmt", "yuv420p", "-preset", "medium", "-crf", "20", "-g", "30",
+            "-c:a", "aac", "-movflags", "+faststart"] + thread_arguments + ["-f", "mp4", target]
+  return [ffmpeg, "-y", "-loglevel", "error", "-i", source, "-vf", scale] + thread_arguments + \
+         ["-f", "image2", "-c:v", "png", target]
+
+def _transcode(ffmpeg, source, target, width, height, threads=None):
+  # runs in a pool process. returns an error message, or None. booths sharing the cache may race, hence the pid
+  temp_path = "{}.{}.tmp".format(target, os.getpid())
+  try:
+    subprocess.run(_ffmpeg_arguments(ffmpeg, source, temp_path, width, height, threads), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  except subprocess.CalledProcessError as e:
+    if exists(temp_path): os.remove(temp_path)
+    return e.stderr.decode(errors="replace").strip() or "ffmpeg exited with code {}".format(e.returncode)
+  except OSError as e:
+    return str(e)
+  os.replace(temp_path, target)
+  return None
+
+class PrepareReport(object):
+
+  def __init__(self):
+    self.cached = 0
+    self.transcoded = 0
+    self.errors = {} # original path -> error message
+
+  def __str__(self):
+    return "{} assets cached, {} transcoded, {} failed".format(self.cached, self.transcoded, len(self.errors))
+
+class AssetCache(object):
+  """
+  Prepared versions of asset files for one display resolution.
+    `prepare(paths)' transcodes whatever isn't cached yet on a process pool, `get(path)' returns the prepared file
+    of an asset, or the asset itself when it wasn't prepared (no ffmpeg, a failed transcode, a new file).
+    `ffmpeg_threads' limits each transcode's threads, for preparing in the background of a session.
+    Unchanged originals are recognized by size and modification time, so they aren't hashed again on every start.
+  """
+
+  def __init__(self, width, height, cache_dir=None, ffmpeg=None, max_workers=None, ffmpeg_threads=None):
+    self.width = width
+    self.height = height
+    self._cache_dir = cache_dir or join(_config_dir, ".asset_cache")
+    self._ffmpeg = ffmpeg or shutil.which("ffmpeg")
+    self._max_workers = max_workers
+    self._ffmpeg_threads = ffmpeg_threads
+    self._manifest_path = join(self._cache_dir, "manifest.json")
+    self._resolution = "{}x{}".format(width, height)
+    self._manifest = {} # original path -> {"<width>x<height>" -> {"size", "mtime", "hash", "prepared"}}
+    self.reload()
+
+  def reload(self):
+    # picks up what another process, like `python -m lib.assets', prepared meanwhile
+    self._manifest = self._read_manifest()
+
+  def get(self, path):
+    entry = self._manifest.get(abspath(path), {}).get(self._resolution)
+    if entry is None:
+      return path
+    prepared_path = join(self._cache_dir, entry["prepared"])
+    return prepared_path if exists(prepared_path) else path
+
+  def is_prepared(self, paths):
+    # whether every asset has a prepared file for this resolution, made from its current version. only stats files
+    for path in paths:
+      path = abspath(path)
+      entry = self._manifest.get(path, {}).get(self._resolution)
+      if entry is None or (entry["size"], entry["mtime"]) != (getsize(path), getmtime(path)) or \
+         not exists(join(self._cache_dir, entry["prepared"])):
+        return False
+    return True
+
+  def prepare(self, paths):
+    report = PrepareReport()
+    if self._ffmpeg is None:
+      report.errors = dict((path, "ffmpeg not found") for path in paths)
+      return report
+    if not exists(self._cache_dir):
+      os.makedirs(self._cache_dir)
+    pending = {} # prepared name -> (original path to transcode, [(original path, entry)])
+    prepared = {} # original path -> entry, of this resolution
+    for path in paths:
+      path = abspath(path)
+      entry = self._get_entry(path)
+      if exists(join(self._cache_dir, entry["prepared"])):
+        prepared[path] = entry
+        report.cached += 1
+      elif entry["prepared"] in pending:
+        # the same content under another name, transcoded once
+        pending[entry["prepared"]][1].append((path, entry))
+      else:
+        pending[entry["prepared"]] = (path, [(path, entry)])
+    if pending:
+      with ProcessPoolExecutor(self._max_workers) as executor:
+        futures = dict((executor.submit(_transcode, self._ffmpeg, source, join(self._cache_dir, prepared_name),
+                                        self.width, self.height, self._ffmpeg_threads), prepared_name)
+                       for prepared_name, (source, _) in pending.items())
+        for future, prepared_name in futures.items():
+          error = future.result()
+          for path, entry in pending[prepared_name][1]:
+            if error is None:
+              prepared[path] = entry
+              report.transcoded += 1
+            else:
+              report.errors[path] = error
+    self._save_manifest(prepared)
+    return report
+
+  def _get_entry(self, path):
+    size, mtime = getsize(path), getmtime(path)
+    # an unchanged original has the same hash at every resolution
+    content_hash = None
+    for entry in self._manifest.get(path, {}).values():
+      if entry["size"] == size and entry["mtime"] == mtime:
+        content_hash = entry["hash"]
+        break
+    if content_hash is None:
+      content_hash = file_hash(path)
+    extension = ".mp4" if splitext(path)[1].lower() in video_extensions else ".png"
+    return {"size": size, "mtime": mtime, "hash": content_hash,
+            "prepared": "{}_{}{}".format(content_hash, self._resolution, extension)}
+
+  def _read_manifest(self):
+    if not exists(self._manifest_path):
+      return {}
+    with open(self._manifest_path, 'r', newline='') as manifest_reader:
+      manifest = json.load(manifest_reader)
+    # entries of the first manifest format, one resolution per original, are dropped. their prepared files are found
+    # again by content hash
+    return dict((path, entries) for path, entries in manifest.items() if "prepared" not in entries)
+
+  def _save_manifest(self, prepared):
+    # booths of other resolutions may have saved since this one read the manifest. their entries are kept by merging
+    # this resolution's into what's on disk now, and the rename replaces the manifest in one step
+    manifest = self._read_manifest()
+    for path, entry in prepared.items():
+      manifest.setdefault(path, {})[self._resolution] = entry
+    temp_path = "{}.{}.tmp".format(self._manifest_path, os.getpid())
+    with open(temp_path, 'w', newline='') as manifest_writer:
+      json.dump(manifest, manifest_writer, indent=2)
+    os.replace(temp_path, self._manifest_path)
+    self._manifest = manifest
+
+def get_asset_paths(video_dir=None):
+  # every condition video and trial image
+  video_dir = video_dir or get_video_dir()
+  video_paths = [join(video_dir, video_name) for video_name in sorted(os.listdir(video_dir))
+                 if splitext(video_name)[1].lower() in video_extensions]
+  return video_paths + get_trial_image_paths()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Transcode PriMate's videos and images to the display resolution")
+  parser.add_argument("--width", type=int, default=1920)
+  parser.add_argument("--height", type=int, default=1080)
+  parser.add_argument("--workers", type=int, default=None, help="transcoding processes, defaults to the core count")
+  parser.add_argument("--background", action="store_true",
+                      help="while trials run: one single threaded transcode at a time, at the lowest priority")
+  args = parser.parse_args()
+  workers, ffmpeg_threads = args.workers, None
+  if args.background:
+    workers, ffmpeg_threads = 1, 1
+    # inherited by the pool and ffmpeg. PriMateApp starts this at idle priority on windows, which has no nice
+    if hasattr(os, "nice"):
+      os.nice(19)
+  prepare_report = AssetCache(args.width, args.height, max_workers=workers, ffmpeg_threads=ffmpeg_threads) \
+      .prepare(get_asset_paths())
+  print(prepare_report)
+  for path, error in sorted(prepare_report.errors.items()):
+    print("  {}: {}".format(path, error))
@@ -0,0 +1,97 @@
+__author__ = 'Mohammed Hamdy'
+
+# throughput and per-stage costs of the parts of a session that don't need a screen.
+# usage: python -m lib.benchmark [--subjects 500] [--sessions 200]
+
+import argparse, shutil, tempfile, time
+from os.path import join
+from lib.payoff import PayoffSchedules
+from lib.simulation import make_colony, run_simulation
+from lib.trialwriter import TrialDataWriter
+from lib.util import SubjectManager
+
+class Timer(object):
+
+  def __enter__(self):
+    self._start_time = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.seconds = time.perf_counter() - self._start_time
+
+def _report(stage, seconds, operations, unit="op"):
+  print("{:<40}{:>10.1f} ms{:>12.2f} us/{}".format(stage, seconds * 1000, seconds / operations * 1e6, unit))
+
+def bench_subject_manager(subject_count, total_trial_count=200):
+  directory = tempfile.mkdtemp(prefix="primate_benchmark_")
+  try:
+    subjects_file_path, video_dir = make_colony(directory, subject_count)
+    with Timer() as timer:
+      subject_manager = SubjectManager(total_trial_count, subjects_file_path, video_dir)
+    _report("SubjectManager() {} subjects".format(subject_count), timer.seconds, 1)
+    subjects = subject_manager.get_subjects()
+    with Timer() as timer:
+      for subject in subjects:
+        subject_manager.is_subject_done(subject)
+    _report("is_subject_done", timer.seconds, subject_count, "subject")
+    with Timer() as timer:
+      subject_manager.get_subject_statuses()
+    _report("get_subject_statuses", timer.seconds, subject_count, "subject")
+    with Timer() as timer:
+      conditions = [(subject, subject_manager.get_unfinished_condition(subject)) for subject in subjects]
+    _report("get_unfinished_condition", timer.seconds, subject_count, "subject")
+    with Timer() as timer:
+      for _ in range(total_trial_count):
+        for subject, condition in conditions:
+          subject_manager.passed_trial(subject, condition)
+    _report("passed_trial (journaled)", timer.seconds, total_trial_count * subject_count, "trial")
+    with Timer() as timer:
+      subject_manager.get_subject_statuses()
+    _report("get_subject_statuses after a condition", timer.seconds, subject_count, "subject")
+    with Timer() as timer:
+      subject_manager.save()
+    _report("save", timer.seconds, 1)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def bench_payoffs(lookup_count=1000000):
+  payoff_schedules = PayoffSchedules()
+  with Timer() as timer:
+    schedule = payoff_schedules.get("high_ranking", "risky")
+  _report("payoff schedule load (cached)", timer.seconds, 1)
+  with Timer() as timer:
+    for trial_index in range(lookup_count):
+      schedule[trial_index]
+  _report("payoff lookup", timer.seconds, lookup_count, "lookup")
+
+def bench_stats_writer(row_count=100000):
+  directory = tempfile.mkdtemp(prefix="primate_benchmark_")
+  try:
+    path = join(directory, "stats.csv")
+    trial_writer = TrialDataWriter(flush_every_rows=100)
+    row = [1, "01-01-16", "10:00:00 AM", "subject1", "High Ranking", "Risky", 3, 0, 0, 1.234, 16.7, 0, 0, 1.240, 6.1, 16.0]
+    with Timer() as enqueue_timer:
+      for _ in range(row_count):
+        trial_writer.write_row(path, row)
+    with Timer() as drain_timer:
+      trial_writer.close()
+    _report("stats row enqueue (main thread)", enqueue_timer.seconds, row_count, "row")
+    _report("stats row drain (writer thread)", drain_timer.seconds, row_count, "row")
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def bench_sessions(session_count):
+  report = run_simulation(session_count)
+  _report("simulated session", report.wall_seconds, report.sessions, "session")
+  _report("simulated trial", report.wall_seconds, report.trials, "trial")
+  print(report)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark the headless parts of PriMate")
+  parser.add_argument("--subjects", type=int, default=500)
+  parser.add_argument("--sessions", type=int, default=200)
+  args = parser.parse_args()
+  bench_subject_manager(args.subjects)
+  bench_payoffs()
+  bench_stats_writer()
+  bench_sessions(args.sessions)
@@ -0,0 +1,231 @@
+__author__ = 'Mohammed Hamdy'
+
+# runs several testing booths from one host, one worker process per booth.
+# usage: python -m lib.booths [config/booths.json]
+#
+# booths.json lists the booths:
+#   [{"name": "booth1", "port": "COM3", "subject": "subject1", "window": {"left": 0, "top": 0, "width": 1920, "height": 1080}},
+#    {"name": "booth2", "port": "COM4", "subject": "subject2", "window": {"left": 1920, "top": 0, "width": 1920, "height": 1080}}]
+# "subject" is optional. without it the booth shows the subject screen as usual.
+# videos and images are transcoded to each "window" size before the booths start, see lib.assets
+
+import json, multiprocessing, os, sys, threading, time
+from multiprocessing.managers import BaseManager
+from os.path import dirname, join, abspath
+from lib.assets import AssetCache, get_asset_paths
+from lib.util import SubjectManager, SubjectStatus
+
+_config_dir = join(dirname(dirname(abspath(__file__))), "config")
+
+class SubjectClaimedError(RuntimeError):
+  # a booth tried to start a subject another booth is running. its subject list was older than the other booth's claim
+  pass
+
+class SubjectCoordinator(object):
+  """
+  The single SubjectManager of all booths, living in the supervisor process.
+    Booths reach it through a multiprocessing manager. A subject is claimed by the booth that starts it and stays
+    claimed until that booth exits, so two booths can never run the same subject (or condition) at once.
+    Booths also report their health here.
+  """
+
+  def __init__(self, subject_manager):
+    self._subject_manager = subject_manager
+    self._lock = threading.Lock()
+    self._claims = {} # subject -> booth
+    self._health = {} # booth -> (report time, metrics)
+
+  def get_subjects(self):
+    with self._lock:
+      return self._subject_manager.get_subjects()
+
+  def get_conditions(self, subject):
+    with self._lock:
+      return self._subject_manager.get_conditions(subject)
+
+  def is_subject_done(self, booth, subject):
+    # a subject running in another booth can't be chosen either
+    with self._lock:
+      if self._claims.get(subject, booth) != booth:
+        return True
+      return self._subject_manager.is_subject_done(subject)
+
+  def get_subject_statuses(self, booth):
+    with self._lock:
+      statuses = self._subject_manager.get_subject_statuses()
+      claims = dict(self._claims)
+    # the manager's cached statuses aren't changed, subjects running elsewhere get a copy naming their booth
+    return [status if claims.get(status.subject, booth) == booth else
+            SubjectStatus(status.subject, status.trials_remaining, status.next_condition, claims[status.subject])
+            for status in statuses]
+
+  def get_unfinished_condition(self, booth, subject):
+    with self._lock:
+      claimed_by = self._claims.setdefault(subject, booth)
+      if claimed_by != booth:
+        raise SubjectClaimedError("subject '{}' is already running in booth '{}'".format(subject, claimed_by))
+      return self._subject_manager.get_unfinished_condition(subject)
+
+  def passed_trial(self, subject, condition):
+    with self._lock:
+      self._subject_manager.passed_trial(subject, condition)
+
+  def save(self):
+    with self._lock:
+      self._subject_manager.save()
+
+  def release_booth(self, booth):
+    with self._lock:
+      for subject in [subject for subject, claimed_by in self._claims.items() if claimed_by == booth]:
+        del self._claims[subject]
+
+  def report_health(self, booth, metrics):
+    with self._lock:
+      self._health[booth] = (time.time(), metrics)
+
+  def get_health(self):
+    with self._lock:
+      claims = dict(self._claims)
+      health = dict(self._health)
+    now = time.time()
+    return dict((booth, dict(metrics, seconds_since_report=now - report_time,
+                             subjects=[subject for subject, claimed_by in claims.items() if claimed_by == booth]))
+                for booth, (report_time, metrics) in health.items())
+
+class CoordinatedSubjectManager(object):
+  # what a booth's PriMateApp uses in place of SubjectManager
+
+  def __init__(self, coordinator, booth):
+    self._coordinator = coordinator
+    self._booth = booth
+
+  def get_subjects(self):
+    return self._coordinator.get_subjects()
+
+  def get_conditions(self, subject):
+    return self._coordinator.get_conditions(subject)
+
+  def is_subject_done(self, subject):
+    return self._coordinator.is_subject_done(self._booth, subject)
+
+  def get_subject_statuses(self):
+    # one round trip for the whole subject screen
+    return self._coordinator.get_subject_statuses(self._booth)
+
+  def get_unfinished_condition(self, subject):
+    return self._coordinator.get_unfinished_condition(self._booth, subject)
+
+  def passed_trial(self, subject, condition):
+    self._coordinator.passed_trial(subject, condition)
+
+  def save(self):
+    self._coordinator.save()
+
+_coordinator = None
+
+def _get_coordinator():
+  return _coordinator
+
+class CoordinatorManager(BaseManager):
+  pass
+
+CoordinatorManager.register("get_coordinator", callable=_get_coordinator)
+
+def run_booth(booth, address, authkey, health_interval=5.0):
+  # entry point of a booth's worker process
+  window = booth.get("window")
+  if window is not None:
+    from kivy.config import Config
+    Config.set("graphics", "position", "custom")
+    for key in ("left", "top", "width", "height"):
+      Config.set("graphics", key, str(window[key]))
+    Config.set("graphics", "borderless", "1")
+  manager = CoordinatorManager(address=address, authkey=authkey)
+  manager.connect()
+  coordinator = manager.get_coordinator()
+  # main.py loads the kv file relative to the working directory
+  os.chdir(dirname(_config_dir))
+  sys.path.insert(0, dirname(_config_dir))
+  from main import PriMateApp
+  app = PriMateApp(subject_manager=CoordinatedSubjectManager(coordinator, booth["name"]),
+                   dispenser_port=booth.get("port"), subject=booth.get("subject"), booth_name=booth["name"])
+  health_stop = threading.Event()
+
+  def report_health():
+    while not health_stop.wait(health_interval):
+      coordinator.report_health(booth["name"], dict(app.get_session_metrics(), pid=os.getpid()))
+
+  health_thread = threading.Thread(target=report_health, name="booth-health")
+  health_thread.daemon = True
+  health_thread.start()
+  try:
+    app.run()
+  finally:
+    health_stop.set()
+    coordinator.report_health(booth["name"], dict(app.get_session_metrics(), pid=os.getpid(), stopped=True))
+
+class BoothSupervisor(object):
+  """
+  Starts a worker process per booth and keeps the shared subject state and booth health while they run.
+    Booths beyond the number of cores are refused, since each one decodes video and renders its own window.
+  """
+
+  def __init__(self, booths, subject_manager=None, health_path=None, health_interval=5.0):
+    if len(booths) > multiprocessing.cpu_count():
+      raise ValueError("{} booths but only {} cores".format(len(booths), multiprocessing.cpu_count()))
+    self._booths = booths
+    self._subject_manager = subject_manager or SubjectManager(200)
+    self._health_path = health_path or join(_config_dir, "booths_health.json")
+    self._health_interval = health_interval
+    self._processes = {}
+
+  def prepare_assets(self):
+    # before any booth runs, so transcoding has every core and booths find their assets ready.
+    # a booth without a "window" gets the window size kivy chooses, and prepares in the background if need be
+    window_sizes = sorted(set((booth["window"]["width"], booth["window"]["height"]) for booth in self._booths
+                              if "window" in booth))
+    asset_paths = get_asset_paths()
+    for width, height in window_sizes:
+      print("{}x{}: {}".format(width, height, AssetCache(width, height).prepare(asset_paths)))
+
+  def run(self):
+    global _coordinator
+    self.prepare_assets()
+    _coordinator = SubjectCoordinator(self._subject_manager)
+    authkey = os.urandom(16)
+    manager = CoordinatorManager(address=("127.0.0.1", 0), authkey=authkey)
+    server = manager.get_server()
+    server_thread = threading.Thread(target=server.serve_forever, name="booth-coordinator")
+    server_thread.daemon = True
+    server_thread.start()
+    # kivy doesn't survive a fork, every booth gets a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    for booth in self._booths:
+      process = context.Process(target=run_booth, args=(booth, server.address, authkey, self._health_interval),
+                                name="booth-" + booth["name"])
+      process.start()
+      self._processes[booth["name"]] = process
+    while self._processes:
+      time.sleep(self._health_interval)
+      for booth_name, process in list(self._processes.items()):
+        if not process.is_alive():
+          print("booth '{}' exited with code {}".format(booth_name, process.exitcode))
+          _coordinator.release_booth(booth_name)
+          del self._processes[booth_name]
+      self._write_health(_coordinator.get_health())
+    self._subject_manager.save()
+
+  def _write_health(self, health):
+    temp_path = self._health_path + ".tmp"
+    with open(temp_path, 'w', newline='') as health_writer:
+      json.dump(health, health_writer, indent=2)
+    os.replace(temp_path, self._health_path)
+    for booth_name, metrics in sorted(health.items()):
+      print("{}: trial {} of {} ({}), {:.0f} trials/hour, last report {:.0f} s ago"
+            .format(booth_name, metrics.get("trial_index"), metrics.get("subject"), metrics.get("condition"),
+                    metrics.get("trials_per_hour", 0), metrics["seconds_since_report"]))
+
+if __name__ == "__main__":
+  booths_path = sys.argv[1] if len(sys.argv) > 1 else join(_config_dir, "booths.json")
+  with open(booths_path, 'r', newline='') as booths_reader:
+    BoothSupervisor(json.load(booths_reader)).run()
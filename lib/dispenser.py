@@ -0,0 +1,153 @@
+__author__ = 'Mohammed Hamdy'
+
+import logging, threading, time
+from collections import deque
+from queue import Queue
+
+# kivy's logger, without importing kivy
+Logger = logging.getLogger("kivy")
+
+# these match the settings dispenser.bat used to pass to `mode COM3'
+_default_port = "COM3"
+_default_baudrate = 19200
+_dispense_command = b"p1\r\n"
+
+class DispenserStats(object):
+  """
+  Latency bookkeeping for dispense commands.
+    Latency is measured from the moment a command is submitted to the moment
+    its bytes were written and flushed to the port.
+  """
+
+  def __init__(self, history_size=1000):
+    self._lock = threading.Lock()
+    self._latencies = deque(maxlen=history_size)
+    self.commands_sent = 0
+    self.commands_failed = 0
+    self.port_reopened = 0
+
+  def record(self, latency):
+    with self._lock:
+      self._latencies.append(latency)
+      self.commands_sent += 1
+
+  def record_failure(self):
+    with self._lock:
+      self.commands_failed += 1
+
+  def record_reopen(self):
+    with self._lock:
+      self.port_reopened += 1
+
+  def summary(self):
+    # latencies are reported in milliseconds
+    with self._lock:
+      latencies = sorted(self._latencies)
+      sent, failed, reopened = self.commands_sent, self.commands_failed, self.port_reopened
+    summary = {"sent": sent, "failed": failed, "reopened": reopened}
+    if latencies:
+      summary.update({"min_ms": latencies[0] * 1000, "max_ms": latencies[-1] * 1000,
+                      "mean_ms": sum(latencies) / len(latencies) * 1000,
+                      "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000})
+    return summary
+
+class PelletDispenser(object):
+  """
+  Talks to the pellet dispenser over a serial port that stays open for the whole session.
+    Commands are queued by the UI thread and written by a background thread,
+    so a slow port never blocks the Kivy loop.
+    A port that can't be opened, or fails a write (like a USB serial adapter pulled out and plugged back in), is
+    opened again for the next command, and a failed write is retried once on the reopened port.
+  """
+
+  def __init__(self, port=_default_port, baudrate=_default_baudrate, command=_dispense_command,
+               serial_factory=None):
+    self._port_name = port
+    self._baudrate = baudrate
+    self._command = command
+    self._serial_factory = serial_factory
+    self._serial = None
+    self._queue = Queue()
+    self._thread = None
+    self.stats = DispenserStats()
+
+  def open(self):
+    # returns whether the port is open. when it isn't, every command tries to open it again
+    if self._thread is not None: return self._serial is not None
+    self._reopen()
+    self._thread = threading.Thread(target=self._run, name="pellet-dispenser")
+    self._thread.daemon = True
+    self._thread.start()
+    return self._serial is not None
+
+  def dispense(self, count=1, on_result=None):
+    # returns immediately. the actual write happens on the dispenser thread, which calls `on_result(delivered)'
+    # for every pellet, delivered being whether its command reached the port
+    for _ in range(count):
+      if self._thread is None:
+        # not opened. count the pellet as lost rather than blocking the caller
+        self.stats.record_failure()
+        if on_result is not None: on_result(False)
+      else:
+        self._queue.put((time.perf_counter(), on_result))
+
+  def close(self):
+    # wait for queued commands to be written before releasing the port
+    if self._thread is None: return
+    self._queue.put(None)
+    self._thread.join()
+    self._thread = None
+    self._close_port()
+
+  def _open_port(self):
+    if self._serial_factory is not None:
+      return self._serial_factory(self._port_name, self._baudrate)
+    import serial
+    return serial.Serial(self._port_name, baudrate=self._baudrate, bytesize=serial.EIGHTBITS,
+                         parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, write_timeout=1)
+
+  def _reopen(self):
+    try:
+      self._serial = self._open_port()
+    except Exception as e:
+      self._serial = None
+      Logger.error("PelletDispenser: could not open {}: {}".format(self._port_name, e))
+      return False
+    return True
+
+  def _close_port(self):
+    if self._serial is None: return
+    try:
+      self._serial.close()
+    except Exception:
+      pass # the device is gone already
+    self._serial = None
+
+  def _write_command(self):
+    # returns whether the command was written
+    for attempt in range(2):
+      if self._serial is None:
+        if not self._reopen(): return False
+        self.stats.record_reopen()
+        Logger.info("PelletDispenser: reopened {}".format(self._port_name))
+      try:
+        self._serial.write(self._command)
+        self._serial.flush()
+        return True
+      except Exception as e:
+        Logger.error("PelletDispenser: writing to {} failed: {}".format(self._port_name, e))
+        self._close_port()
+    return False
+
+  def _run(self):
+    while True:
+      command = self._queue.get()
+      if command is None: break
+      submitted_at, on_result = command
+      delivered = self._write_command()
+      if delivered:
+        self.stats.record(time.perf_counter() - submitted_at)
+      else:
+        self.stats.record_failure()
+      if on_result is not None:
+        on_result(delivered)
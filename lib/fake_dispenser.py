@@ -0,0 +1,77 @@
+__author__ = 'Mohammed Hamdy'
+
+# a pseudo-terminal that behaves like the pellet dispenser, for testing without hardware (posix only).
+# usage:
+#   with FakeDispenserDevice() as device:
+#     dispenser = PelletDispenser(port=device.port)
+#     dispenser.dispense(3)
+#     dispenser.close()
+#     device.wait_for_pellets(3)
+
+import os, pty, select, threading, time, tty
+
+class FakeDispenserDevice(object):
+
+  def __init__(self, command=b"p1"):
+    self._command = command
+    self._master_fd = None
+    self._slave_fd = None
+    self._thread = None
+    self._stopping = threading.Event()
+    self._lock = threading.Lock()
+    self._buffer = b""
+    self.port = None
+    self.received = b"" # everything written to the port
+    self.pellets_dispensed = 0
+
+  def start(self):
+    self._master_fd, self._slave_fd = pty.openpty()
+    # don't let the line discipline echo or translate what the dispenser driver writes
+    tty.setraw(self._slave_fd)
+    self.port = os.ttyname(self._slave_fd)
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._read_commands, args=(self._master_fd, ), name="fake-dispenser")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    # like unplugging the dispenser: writes to an open port fail from now on.
+    # the reader is stopped before its fd is closed, or it would read whatever pty gets the fd number next
+    if self._master_fd is None: return
+    self._stopping.set()
+    self._thread.join()
+    os.close(self._slave_fd)
+    os.close(self._master_fd)
+    self._master_fd = self._slave_fd = None
+
+  def wait_for_pellets(self, count, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      if self.pellets_dispensed >= count:
+        return True
+      time.sleep(0.01)
+    return False
+
+  def _read_commands(self, master_fd):
+    while not self._stopping.is_set():
+      if not select.select([master_fd], [], [], 0.05)[0]: continue
+      try:
+        data = os.read(master_fd, 1024)
+      except OSError:
+        return # device stopped
+      if not data: return
+      with self._lock:
+        self.received += data
+        self._buffer += data
+        lines = self._buffer.split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+          if line.strip() == self._command:
+            self.pellets_dispensed += 1
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.stop()
@@ -0,0 +1,65 @@
+__author__ = 'Mohammed Hamdy'
+
+import json, os
+
+class ProgressJournal(object):
+  """
+  Append-only log of condition updates made to `subjects.json' since it was last saved.
+    Each record is a single json line: {"s": subject, "c": condition name, "u": {updated props}, "d": [deleted props]}
+    Replaying the records over `subjects.json' restores the progress of a crashed session.
+  """
+
+  def __init__(self, path, fsync=False):
+    self._path = path
+    self._fsync = fsync
+    self._file = None
+    self.record_count = 0
+
+  def replay(self):
+    # returns the records written since the last reset. a half written last line (crash mid write) is ignored
+    records = []
+    try:
+      with open(self._path, 'r', newline='') as journal:
+        for line in journal:
+          try:
+            records.append(json.loads(line))
+          except ValueError:
+            break
+    except IOError:
+      pass
+    self.record_count = len(records)
+    return records
+
+  def append(self, subject, condition_name, updated=None, deleted=None):
+    record = {"s": subject, "c": condition_name}
+    if updated: record["u"] = updated
+    if deleted: record["d"] = deleted
+    journal = self._get_file()
+    journal.write(json.dumps(record, separators=(',', ':')) + "\n")
+    # flushing hands the record to the OS, so it survives the app crashing.
+    # fsync additionally makes it survive a power cut, at the cost of waiting for the disk
+    journal.flush()
+    if self._fsync:
+      os.fsync(journal.fileno())
+    self.record_count += 1
+
+  def reset(self):
+    # should be called after the records were compacted into `subjects.json'
+    self.close()
+    open(self._path, 'w').close()
+    self.record_count = 0
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def _get_file(self):
+    if self._file is None:
+      self._file = open(self._path, 'a', newline='')
+    return self._file
+
+def apply_journal_record(condition_info, record):
+  condition_info.update(record.get("u", {}))
+  for key in record.get("d", []):
+    condition_info.pop(key, None)
@@ -0,0 +1,96 @@
+__author__ = 'Mohammed Hamdy'
+
+import gc, time, tracemalloc
+from collections import Counter
+
+# objects made per trial or per screen change. if any of them keeps growing, something holds on to them
+default_tracked_types = ("TrialData", "TimelineEvent", "partial", "ClockEvent", "WeakMethod", "Texture",
+                         "TextIOWrapper", "BufferedWriter")
+
+class MemoryCheckpoint(object):
+
+  def __init__(self, label, seconds, traced_bytes, object_counts, top_growth):
+    self.label = label
+    self.seconds = seconds # since the baseline
+    self.traced_bytes = traced_bytes
+    self.object_counts = object_counts # type name -> live count
+    self.top_growth = top_growth # tracemalloc StatisticDiff, largest growth since the baseline first
+
+class MemoryProfiler(object):
+  """
+  Compares memory at checkpoints, like condition and trial block boundaries, against a baseline.
+    Each checkpoint takes a tracemalloc snapshot and counts live objects of `tracked_types' (by type name, so kivy's
+    Texture and ClockEvent are counted without importing kivy). Growth since the baseline above `growth_threshold_kb'
+    or `count_threshold' objects of a type is flagged. Every checkpoint is appended to the report at `report_path'.
+    tracemalloc slows allocations down noticeably, so this is only for profiling runs.
+  """
+
+  def __init__(self, report_path, growth_threshold_kb=1024, count_threshold=100,
+               tracked_types=default_tracked_types, top_count=10, traceback_frames=1):
+    self._report_path = report_path
+    self._growth_threshold = growth_threshold_kb * 1024
+    self._count_threshold = count_threshold
+    self._tracked_types = set(tracked_types)
+    self._top_count = top_count
+    self._traceback_frames = traceback_frames
+    self._baseline_snapshot = None
+    self._baseline = None
+    self._start_time = None
+    self.flagged = [] # (checkpoint label, message)
+
+  def start(self, label="baseline"):
+    tracemalloc.start(self._traceback_frames)
+    self._start_time = time.perf_counter()
+    self._baseline_snapshot, self._baseline = self._take(label, None)
+    with open(self._report_path, 'w', newline='') as report_writer:
+      report_writer.write("memory profile, flagging growth above {:.0f} KiB or {} objects of a type\n\n"
+                          .format(self._growth_threshold / 1024, self._count_threshold))
+    self._write(self._baseline, [])
+
+  def checkpoint(self, label):
+    # returns the flags of this checkpoint
+    _, checkpoint = self._take(label, self._baseline_snapshot)
+    flags = []
+    growth = checkpoint.traced_bytes - self._baseline.traced_bytes
+    if growth > self._growth_threshold:
+      flags.append("traced memory grew {:.0f} KiB".format(growth / 1024))
+    for type_name, count in sorted(checkpoint.object_counts.items()):
+      count_growth = count - self._baseline.object_counts.get(type_name, 0)
+      if count_growth > self._count_threshold:
+        flags.append("{} grew by {} to {}".format(type_name, count_growth, count))
+    self.flagged.extend((label, flag) for flag in flags)
+    self._write(checkpoint, flags)
+    return flags
+
+  def stop(self):
+    tracemalloc.stop()
+    with open(self._report_path, 'a', newline='') as report_writer:
+      report_writer.write("{} checkpoints flagged\n".format(len(set(label for label, _ in self.flagged))))
+
+  def _take(self, label, baseline_snapshot):
+    # collect first, only leaks should survive
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    traced_bytes = sum(statistic.size for statistic in snapshot.statistics("filename"))
+    object_counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+    object_counts = dict((type_name, object_counts.get(type_name, 0)) for type_name in self._tracked_types)
+    top_growth = []
+    if baseline_snapshot is not None:
+      top_growth = [statistic for statistic in snapshot.compare_to(baseline_snapshot, "lineno")[:self._top_count]
+                    if statistic.size_diff > 0]
+    return snapshot, MemoryCheckpoint(label, time.perf_counter() - self._start_time, traced_bytes, object_counts,
+                                      top_growth)
+
+  def _write(self, checkpoint, flags):
+    lines = ["[{:.0f} s] {}: {:.0f} KiB traced ({:+.0f} KiB)".format(
+        checkpoint.seconds, checkpoint.label, checkpoint.traced_bytes / 1024,
+        (checkpoint.traced_bytes - self._baseline.traced_bytes) / 1024)]
+    lines.append("  objects: " + ", ".join("{} {}".format(type_name, count)
+                                           for type_name, count in sorted(checkpoint.object_counts.items())))
+    for statistic in checkpoint.top_growth:
+      lines.append("  {:+.1f} KiB {:+d} blocks  {}".format(statistic.size_diff / 1024, statistic.count_diff,
+                                                          statistic.traceback))
+    for flag in flags:
+      lines.append("  FLAGGED: " + flag)
+    with open(self._report_path, 'a', newline='') as report_writer:
+      report_writer.write("\n".join(lines) + "\n\n")
@@ -0,0 +1,130 @@
+__author__ = 'Mohammed Hamdy'
+
+import json, os
+from bisect import bisect_left
+from functools import partial
+from lib import timing
+from lib.timeline import TimelineEvent
+
+# histogram bucket upper bounds in seconds, from 1 ms to 10 s
+default_buckets = (0.001, 0.002, 0.004, 0.008, 0.0167, 0.025, 0.033, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+class Histogram(object):
+  """
+  Counts observations into fixed buckets. Observing is a bisect and two additions, cheap enough to leave on.
+  """
+
+  def __init__(self, buckets=default_buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # the last bucket is +Inf
+    self.count = 0
+    self.sum = 0.
+    self.max = 0.
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def quantile(self, q):
+    # upper bound of the bucket holding the q-th observation
+    if self.count == 0: return None
+    rank = q * self.count
+    seen = 0
+    for index, bucket_count in enumerate(self.counts):
+      seen += bucket_count
+      if seen >= rank:
+        return self.buckets[index] if index < len(self.buckets) else self.max
+    return self.max
+
+  def summary(self):
+    if self.count == 0:
+      return {"count": 0}
+    return {"count": self.count, "mean_ms": self.sum / self.count * 1000, "max_ms": self.max * 1000,
+            "p50_ms": self.quantile(0.5) * 1000, "p90_ms": self.quantile(0.9) * 1000, "p99_ms": self.quantile(0.99) * 1000}
+
+class MetricsRegistry(object):
+  """
+  Named histograms with labels, exported as a Prometheus text file and a json summary.
+  """
+
+  def __init__(self, prefix="primate"):
+    self._prefix = prefix
+    self._histograms = {} # (name, labels) -> Histogram
+    self._help = {}
+
+  def histogram(self, name, help_text="", **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = self._histograms.get(key)
+    if histogram is None:
+      histogram = self._histograms[key] = Histogram()
+      self._help.setdefault(name, help_text)
+    return histogram
+
+  def timed(self, name, function, **labels):
+    # wraps a function to observe its duration in the `name' histogram
+    histogram = self.histogram(name, **labels)
+
+    def timed_function(*args, **kwargs):
+      start_time = timing.now()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        histogram.observe(timing.now() - start_time)
+    return timed_function
+
+  def export_prometheus(self, path):
+    lines = []
+    for name in sorted(set(name for name, _ in self._histograms)):
+      full_name = "{}_{}".format(self._prefix, name)
+      if self._help.get(name):
+        lines.append("# HELP {} {}".format(full_name, self._help[name]))
+      lines.append("# TYPE {} histogram".format(full_name))
+      for (histogram_name, labels), histogram in sorted(self._histograms.items()):
+        if histogram_name != name: continue
+        label_text = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+        cumulative = 0
+        for bound, bucket_count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+          cumulative += bucket_count
+          bucket_labels = ",".join(filter(None, [label_text, 'le="{}"'.format(bound)]))
+          lines.append("{}_bucket{{{}}} {}".format(full_name, bucket_labels, cumulative))
+        suffix = "{{{}}}".format(label_text) if label_text else ""
+        lines.append("{}_sum{} {}".format(full_name, suffix, histogram.sum))
+        lines.append("{}_count{} {}".format(full_name, suffix, histogram.count))
+    self._write_atomically(path, "\n".join(lines) + "\n")
+
+  def summary(self):
+    return dict((name + "".join("[{}={}]".format(key, value) for key, value in labels), histogram.summary())
+                for (name, labels), histogram in sorted(self._histograms.items()))
+
+  def write_summary(self, path, **extra):
+    self._write_atomically(path, json.dumps(dict(extra, histograms=self.summary()), indent=2))
+
+  def _write_atomically(self, path, text):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', newline='') as metrics_writer:
+      metrics_writer.write(text)
+    os.replace(temp_path, path)
+
+def callback_name(callback):
+  # trial timeline wake ups are named after their event, like "timeline_blank"
+  if isinstance(callback, partial) and callback.args and isinstance(callback.args[0], TimelineEvent):
+    return "timeline_" + callback.args[0].name
+  while isinstance(callback, partial):
+    callback = callback.func
+  return getattr(callback, "__name__", type(callback).__name__)
+
+class InstrumentedClock(object):
+  """
+  Wraps a clock (kivy's Clock) so every callback scheduled through it is timed in the `callback_seconds' histogram.
+  """
+
+  def __init__(self, clock, registry):
+    self._clock = clock
+    self._registry = registry
+
+  def schedule_once(self, callback, timeout=0):
+    timed_callback = self._registry.timed("callback_seconds", callback, callback=callback_name(callback))
+    return self._clock.schedule_once(timed_callback, timeout)
@@ -0,0 +1,61 @@
+__author__ = 'Mohammed Hamdy'
+
+from os.path import dirname, join, abspath, exists
+from array import array
+import csv, json
+
+_config_dir = join(dirname(dirname(__file__)), "config")
+
+class PayoffSchedule(object):
+  """
+  Pellet counts of a payoff csv, one per trial, held in a compact array.
+    Trials past the end of the schedule wrap around to its start, so an 80 row schedule repeats through a 200 trial condition.
+  """
+
+  def __init__(self, name, pellet_counts):
+    if len(pellet_counts) == 0:
+      raise ValueError("payoff schedule '{}' is empty".format(name))
+    self.name = name
+    self._pellet_counts = array('H', pellet_counts)
+
+  def __getitem__(self, trial_index):
+    return self._pellet_counts[trial_index % len(self._pellet_counts)]
+
+  def __len__(self):
+    return len(self._pellet_counts)
+
+# schedules are loaded once per process and shared between sessions
+_loaded_schedules = {}
+
+def load_payoff_schedule(path):
+  path = abspath(path)
+  if path not in _loaded_schedules:
+    with open(path, 'r', newline='') as payoff_file:
+      pellet_counts = [int(row[0]) for row in csv.reader(payoff_file) if row]
+    _loaded_schedules[path] = PayoffSchedule(path, pellet_counts)
+  return _loaded_schedules[path]
+
+class PayoffSchedules(object):
+  """
+  Chooses the payoff schedules used by each condition.
+    Every condition gets the "risky" and "safe" EPGT schedules unless `payoffs.json' names other files for it:
+      {"stranger": {"risky": "stranger_risky.csv", "safe": "stranger_safe.csv"}}
+    File names are relative to the config directory.
+  """
+
+  _default_schedule_files = {"risky": "EPGT_Payoff_Risky.csv", "safe": "EPGT_Payoff.csv"}
+
+  def __init__(self, config_dir=_config_dir):
+    self._config_dir = config_dir
+    self._condition_schedule_files = {}
+    path_overrides = join(config_dir, "payoffs.json")
+    if exists(path_overrides):
+      with open(path_overrides, 'r', newline='') as overrides_reader:
+        self._condition_schedule_files = json.load(overrides_reader)
+
+  def get(self, condition_name, schedule_name):
+    schedule_files = self._condition_schedule_files.get(condition_name, {})
+    file_name = schedule_files.get(schedule_name, self._default_schedule_files.get(schedule_name))
+    if file_name is None:
+      raise KeyError("no payoff schedule named '{}' for condition '{}'".format(schedule_name, condition_name))
+    return load_payoff_schedule(join(self._config_dir, file_name))
@@ -0,0 +1,167 @@
+__author__ = 'Mohammed Hamdy'
+
+from functools import partial
+from os.path import join, exists
+from lib import timing
+from lib.timeline import TrialTimeline
+from lib.util import TrialData, variablize_string
+
+stats_header = ["Trial Index", "Date", "Time", "Subject", "Condition", "Card Selected",
+                "Pellets Dispensed", "Background Touches",
+                "Video Touches", "Time till Choice (sec)", "Video First Frame (ms)",
+                "Video Late Frames", "Video Dropped Frames", "Time till Choice Handled (sec)",
+                "Touch Delay (ms)", "Trial Onset Delay (ms)", "Pellets Delivered"]
+
+timeline_header = ["Trial Index", "Event", "Planned (sec)", "Actual (sec)", "Error (ms)"]
+
+class TrialSession(object):
+  """
+  Runs the trials of a subject's condition: start trial -> trial -> pellets -> blank -> next trial.
+    Doesn't depend on kivy. Waiting goes through `clock', which only needs kivy Clock's `schedule_once(callback, timeout)',
+    and everything shown to the subject goes through `ui':
+      ui.show_screen(name): one of "start_trial", "trial", "blank_screen" or "condition_complete"
+      ui.collect_trial_data(trial_data): fill in what only the screens know, like touch counts
+    PriMateApp drives it with kivy's Clock and screens. lib.simulation drives it with a virtual clock, and its time as `now'.
+    Everything after a choice (pellets, blank, next trial) runs on a TrialTimeline anchored at the choice, and the
+    planned and actual time of each event goes to `timeline_<subject>.csv', and to `on_timeline_event(event)' if given.
+    A trial's stats row is written when its blank shows, so it has the pellets the dispenser actually delivered.
+  """
+
+  inter_pellet_wait_seconds = 0.4
+  reward_period_seconds = 6
+  blank_seconds = 10
+
+  def __init__(self, subject_manager, payoff_schedules, dispenser, trial_writer, clock, ui, stats_dir,
+               total_trial_count=200, now=timing.now, on_timeline_event=None):
+    self._subject_manager = subject_manager
+    self._payoff_schedules = payoff_schedules
+    self._dispenser = dispenser
+    self._trial_writer = trial_writer
+    self._clock = clock
+    self._ui = ui
+    self._stats_dir = stats_dir
+    self._total_trial_count = total_trial_count
+    self._timeline = TrialTimeline(clock, now, self._write_timeline_event)
+    self._on_timeline_event = on_timeline_event
+    self._index_current_trial = None
+    self._payoff_risky = None
+    self._payoff_safe = None
+    self.subject = None
+    self.condition = None
+    self.trial_data = None
+    self.count_left_card_chosen = 0
+    self.count_right_card_chosen = 0
+
+  def start(self, subject):
+    # now we have a subject selected, we can get it's next condition. returns the condition
+    new_subject = len(self._subject_manager.get_conditions(subject)) == 0
+    # claims the subject when booths share the subject manager, so it goes first. a subject running in another booth
+    # raises booths.SubjectClaimedError and leaves the session as it was
+    condition_subject = self._subject_manager.get_unfinished_condition(subject)
+    self.subject = subject
+    # write a csv with header for the new subject. only created if the subject ran no trials before
+    if new_subject:
+      self._trial_writer.start_file(self.get_stats_file_name(), stats_header)
+    else:
+      # files started before columns were added get the full header
+      self._trial_writer.ensure_header(self.get_stats_file_name(), stats_header)
+    if not exists(self.get_timeline_file_name()):
+      self._trial_writer.start_file(self.get_timeline_file_name(), timeline_header)
+    self._index_current_trial = condition_subject.next_trial_index
+    # payoffs are looked up by trial index, so resuming needs no skipping
+    self._payoff_risky = self._payoff_schedules.get(condition_subject.condition_name, "risky")
+    self._payoff_safe = self._payoff_schedules.get(condition_subject.condition_name, "safe")
+    self.condition = condition_subject
+    return condition_subject
+
+  def begin(self):
+    # show the first trial. separate from start so the ui can be prepared for the condition in between
+    self._restart_trial()
+
+  def show_trial(self):
+    # the start trial button was pressed
+    self._ui.show_screen("trial")
+
+  def left_card_chosen(self, choice_timing):
+    count_pellets = self._payoff_risky[self.trial_data.trial_index]
+    self._update_trial_data(choice_timing, "Risky", count_pellets)
+    self.count_left_card_chosen += 1
+    self._plan_reward(count_pellets)
+
+  def right_card_chosen(self, choice_timing):
+    count_pellets = self._payoff_safe[self.trial_data.trial_index]
+    self._update_trial_data(choice_timing, "Safe", count_pellets)
+    self.count_right_card_chosen += 1
+    self._plan_reward(count_pellets)
+
+  def get_stats_file_name(self):
+    # stats file name should include the name of the current subject
+    return join(self._stats_dir, "stats_{}.csv".format(variablize_string(self.subject)))
+
+  def get_timeline_file_name(self):
+    return join(self._stats_dir, "timeline_{}.csv".format(variablize_string(self.subject)))
+
+  def get_timeline_jitter(self):
+    return self._timeline.get_jitter_summary()
+
+  def _plan_reward(self, count_pellets):
+    # pellets every inter pellet wait from the choice on. the blank comes when the reward period is over,
+    # or after the last pellet's wait when there are too many pellets to fit it
+    timeline = self._timeline
+    timeline.start(self.trial_data.trial_index)
+    for index in range(count_pellets):
+      timeline.plan("dispense", index * self.inter_pellet_wait_seconds, self._dispense_pellet)
+    blank_onset = max(self.reward_period_seconds, count_pellets * self.inter_pellet_wait_seconds)
+    timeline.plan("blank", blank_onset, self._go_to_blank)
+    # keep the blank for 10 seconds
+    timeline.plan("next_trial", blank_onset + self.blank_seconds, self._restart_trial)
+
+  def _dispense_pellet(self):
+    self._dispenser.dispense(1, partial(self._pellet_dispensed, self.trial_data))
+
+  def _pellet_dispensed(self, trial, delivered):
+    # from the dispenser's thread
+    if delivered:
+      trial.pellets_delivered += 1
+
+  def _go_to_blank(self):
+    self._ui.show_screen("blank_screen")
+    self._write_trial_data()
+    self._subject_manager.passed_trial(self.subject, self.condition)
+
+  def _write_timeline_event(self, event):
+    self._trial_writer.write_row(self.get_timeline_file_name(),
+                                 [event.trial_index + 1, event.name, event.planned, event.actual, event.error * 1000])
+    if self._on_timeline_event is not None:
+      self._on_timeline_event(event)
+
+  def _restart_trial(self):
+    if self._index_current_trial == self._total_trial_count:
+      self._index_current_trial = 0
+      self._subject_manager.save()
+      self._ui.show_screen("condition_complete")
+    else:
+      self.trial_data = TrialData(self.subject, self._index_current_trial, self.condition.name)
+      self._ui.show_screen("start_trial")
+    self._index_current_trial += 1
+
+  def _update_trial_data(self, choice_timing, card_name, pellets_dispensed):
+    # choice_timing: timing.ChoiceTiming()
+    trial = self.trial_data
+    trial.time_till_selection = choice_timing.time_till_choice
+    trial.time_till_selection_handled = choice_timing.time_till_handled
+    trial.touch_delay = choice_timing.touch_delay * 1000
+    trial.trial_onset_delay = choice_timing.onset_delay * 1000
+    trial.card_selected = card_name
+    trial.pellets_dispensed = pellets_dispensed
+    self._ui.collect_trial_data(trial)
+
+  def _write_trial_data(self):
+    # queued for the writer thread so disk stalls never delay the reward
+    trial = self.trial_data
+    self._trial_writer.write_row(self.get_stats_file_name(),
+                                 [trial.trial_index + 1, trial.date, trial.time, trial.subject, trial.condition,
+                                  trial.card_selected, trial.pellets_dispensed, trial.background_touches,
+                                  trial.video_touches, trial.time_till_selection, trial.video_first_frame_latency,
+                                  trial.video_late_frames, trial.video_dropped_frames, trial.time_till_selection_handled,
+                                  trial.touch_delay, trial.trial_onset_delay, trial.pellets_delivered])
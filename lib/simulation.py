@@ -0,0 +1,228 @@
+__author__ = 'Mohammed Hamdy'
+
+# runs the trial state machine headless against a virtual clock, with simulated subjects and a fake dispenser.
+# usage: python -m lib.simulation --sessions 1000 --policy win_stay_lose_shift
+
+import argparse, heapq, json, random, shutil, tempfile, time
+from os import mkdir
+from os.path import join
+from lib.memprofile import MemoryProfiler
+from lib.payoff import PayoffSchedules
+from lib.session import TrialSession
+from lib.timing import ChoiceTiming
+from lib.util import SubjectManager
+
+class VirtualClock(object):
+  """
+  Stands in for kivy's Clock. Time only passes when the next scheduled callback runs, so hours of trials take no time.
+  """
+
+  def __init__(self):
+    self.time = 0.
+    self._events = []
+    self._sequence = 0 # keeps callbacks scheduled for the same time in scheduling order
+
+  def schedule_once(self, callback, timeout=0):
+    # like kivy, a negative timeout runs the callback as soon as possible
+    heapq.heappush(self._events, (self.time + max(0, timeout), self._sequence, callback))
+    self._sequence += 1
+
+  def run(self):
+    while self._events:
+      event_time, _, callback = heapq.heappop(self._events)
+      elapsed, self.time = event_time - self.time, event_time
+      callback(elapsed)
+
+class FakeDispenser(object):
+
+  def __init__(self):
+    self.pellets_dispensed = 0
+
+  def open(self):
+    pass
+
+  def dispense(self, count=1, on_result=None):
+    self.pellets_dispensed += count
+    if on_result is not None:
+      for _ in range(count):
+        on_result(True)
+
+  def close(self):
+    pass
+
+class MemoryTrialWriter(object):
+  # keeps stats rows in memory, with the same interface as trialwriter.TrialDataWriter
+
+  def __init__(self):
+    self.rows = {}
+
+  def start_file(self, path, header):
+    self.rows[path] = [header]
+
+  def ensure_header(self, path, header):
+    if path in self.rows and len(self.rows[path][0]) < len(header):
+      self.rows[path][0] = header
+
+  def write_row(self, path, row):
+    self.rows.setdefault(path, []).append(row)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+class DiscardingTrialWriter(MemoryTrialWriter):
+  # drops stats rows, so a memory profile only shows what's left behind by the sessions themselves
+
+  def write_row(self, path, row):
+    pass
+
+# choice policies. a policy takes the subject's history, a list of (card, pellets) for its previous trials,
+# and a random.Random. it returns "left" (risky) or "right" (safe)
+
+def always_left(history, rng):
+  return "left"
+
+def always_right(history, rng):
+  return "right"
+
+def random_choice(history, rng, left_probability=0.5):
+  return "left" if rng.random() < left_probability else "right"
+
+def win_stay_lose_shift(history, rng, win_pellets=2):
+  # repeat the last card when it paid well, otherwise switch
+  if not history:
+    return random_choice(history, rng)
+  last_card, last_pellets = history[-1]
+  if last_pellets >= win_pellets:
+    return last_card
+  return "right" if last_card == "left" else "left"
+
+policies = {"left": always_left, "right": always_right, "random": random_choice,
+            "win_stay_lose_shift": win_stay_lose_shift}
+
+class SimulatedSubject(object):
+  """
+  Plays the screens of a TrialSession: presses start, then picks a card after a random choice time.
+    choice_time: (min, max) seconds, uniformly distributed
+  """
+
+  def __init__(self, clock, policy, rng, choice_time=(0.5, 4.0), start_delay=1.0):
+    self._clock = clock
+    self._policy = policy
+    self._rng = rng
+    self._choice_time = choice_time
+    self._start_delay = start_delay
+    self.session = None
+    self.history = []
+    self.completed = False
+
+  def show_screen(self, name):
+    if name == "start_trial":
+      self._clock.schedule_once(lambda elapsed: self.session.show_trial(), self._start_delay)
+    elif name == "trial":
+      choice_time = self._rng.uniform(*self._choice_time)
+      self._clock.schedule_once(lambda elapsed: self._choose(choice_time), choice_time)
+    elif name == "condition_complete":
+      self.completed = True
+
+  def collect_trial_data(self, trial_data):
+    trial_data.background_touches = self._rng.randint(0, 3)
+    trial_data.video_touches = self._rng.randint(0, 2)
+
+  def _choose(self, choice_time):
+    card = self._policy(self.history, self._rng)
+    choice_timing = ChoiceTiming(0, choice_time, choice_time, 0)
+    if card == "left":
+      self.session.left_card_chosen(choice_timing)
+    else:
+      self.session.right_card_chosen(choice_timing)
+    self.history.append((card, self.session.trial_data.pellets_dispensed))
+
+class SimulationReport(object):
+
+  def __init__(self):
+    self.sessions = 0
+    self.trials = 0
+    self.left_chosen = 0
+    self.right_chosen = 0
+    self.pellets_dispensed = 0
+    self.virtual_seconds = 0.
+    self.wall_seconds = 0.
+
+  def __str__(self):
+    return ("{} sessions, {} trials ({} left / {} right), {} pellets\n"
+            "{:.1f} simulated hours in {:.2f} s: {:.0f} sessions/s, {:.0f} trials/s"
+            .format(self.sessions, self.trials, self.left_chosen, self.right_chosen, self.pellets_dispensed,
+                    self.virtual_seconds / 3600, self.wall_seconds, self.sessions / self.wall_seconds,
+                    self.trials / self.wall_seconds))
+
+def make_colony(directory, subject_count, condition_names=("high_ranking", "low_ranking", "nonsocial", "stranger")):
+  # writes a subjects.json and empty condition videos for a simulated colony. returns (subjects file, video dir)
+  subjects_file_path = join(directory, "subjects.json")
+  with open(subjects_file_path, 'w', newline='') as subjects_writer:
+    json.dump([{"name": "subject{}".format(index + 1)} for index in range(subject_count)], subjects_writer)
+  video_dir = join(directory, "videos")
+  mkdir(video_dir)
+  for condition_name in condition_names:
+    open(join(video_dir, condition_name + ".mp4"), 'w').close()
+  return subjects_file_path, video_dir
+
+def run_simulation(session_count, policy=random_choice, total_trial_count=200, seed=0, trial_writer=None,
+                   memory_profiler=None):
+  # runs `session_count' full conditions, 4 per simulated subject, and returns a SimulationReport.
+  # a memprofile.MemoryProfiler gets a checkpoint after every session
+  rng = random.Random(seed)
+  directory = tempfile.mkdtemp(prefix="primate_simulation_")
+  try:
+    subjects_file_path, video_dir = make_colony(directory, (session_count + 3) // 4)
+    subject_manager = SubjectManager(total_trial_count, subjects_file_path, video_dir)
+    payoff_schedules = PayoffSchedules()
+    trial_writer = trial_writer or MemoryTrialWriter()
+    dispenser = FakeDispenser()
+    report = SimulationReport()
+    clock = VirtualClock()
+    if memory_profiler is not None:
+      memory_profiler.start()
+    start_time = time.perf_counter()
+    for subject in subject_manager.get_subjects():
+      while report.sessions < session_count and not subject_manager.is_subject_done(subject):
+        simulated_subject = SimulatedSubject(clock, policy, rng)
+        session = TrialSession(subject_manager, payoff_schedules, dispenser, trial_writer, clock, simulated_subject,
+                               directory, total_trial_count, lambda: clock.time)
+        simulated_subject.session = session
+        session.start(subject)
+        session.begin()
+        clock.run()
+        report.sessions += 1
+        report.left_chosen += session.count_left_card_chosen
+        report.right_chosen += session.count_right_card_chosen
+        if memory_profiler is not None:
+          memory_profiler.checkpoint("session {}".format(report.sessions))
+      if report.sessions == session_count: break
+    trial_writer.close()
+    report.wall_seconds = time.perf_counter() - start_time
+    if memory_profiler is not None:
+      memory_profiler.stop()
+    report.trials = report.left_chosen + report.right_chosen
+    report.pellets_dispensed = dispenser.pellets_dispensed
+    report.virtual_seconds = clock.time
+    return report
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run PriMate sessions headless against a virtual clock")
+  parser.add_argument("--sessions", type=int, default=100)
+  parser.add_argument("--trials", type=int, default=200, help="trials per condition")
+  parser.add_argument("--policy", choices=sorted(policies), default="random")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--memory-report", help="profile memory after every session into this file (slow)")
+  args = parser.parse_args()
+  memory_profiler, trial_writer = None, None
+  if args.memory_report:
+    memory_profiler, trial_writer = MemoryProfiler(args.memory_report), DiscardingTrialWriter()
+  print(run_simulation(args.sessions, policies[args.policy], args.trials, args.seed, trial_writer, memory_profiler))
+  if memory_profiler is not None:
+    print("memory report in {}, {} flags".format(args.memory_report, len(memory_profiler.flagged)))
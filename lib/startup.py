@@ -2,8 +2,10 @@
 import sys
 from os import path
 from subprocess import call
+from importlib.util import find_spec
 
-# find kivy's python and execute kivy.bat
+# find kivy's python and execute kivy.bat. skipped when kivy is already importable, since starting a shell for it is slow
 
-path_kivy_bat = path.join(path.dirname(path.dirname(sys.executable)), "kivy.bat")
-call(path_kivy_bat)
+if find_spec("kivy") is None:
+  path_kivy_bat = path.join(path.dirname(path.dirname(sys.executable)), "kivy.bat")
+  call(path_kivy_bat)
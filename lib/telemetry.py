@@ -0,0 +1,184 @@
+__author__ = 'Mohammed Hamdy'
+
+# streams trial events from booths to a local monitor.
+# usage: python -m lib.telemetry [address]    address like tcp:127.0.0.1:7700 (default) or unix:/tmp/primate.sock
+#
+# a booth publishes with PRIMATE_TELEMETRY=<address>. the monitor listens and booths connect to it, so one monitor
+# sees every booth, and booths keep running (dropping their oldest events) while no monitor is up.
+# every message is a json object framed by its length as a 4 byte big endian integer
+
+import argparse, json, selectors, socket, struct, threading, time
+from collections import deque
+
+default_address = "tcp:127.0.0.1:7700"
+_length = struct.Struct(">I")
+
+def parse_address(address):
+  # returns (socket family, address for connect/bind)
+  kind, _, location = address.partition(":")
+  if kind == "unix":
+    return socket.AF_UNIX, location
+  if kind == "tcp":
+    host, _, port = location.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+  raise ValueError("telemetry address should be tcp:<host>:<port> or unix:<path>, not '{}'".format(address))
+
+def encode_frame(message):
+  payload = json.dumps(message, separators=(",", ":")).encode()
+  return _length.pack(len(payload)) + payload
+
+class FrameDecoder(object):
+  # collects received bytes and returns the complete messages among them
+
+  def __init__(self):
+    self._buffer = bytearray()
+
+  def feed(self, data):
+    self._buffer.extend(data)
+    messages = []
+    while len(self._buffer) >= _length.size:
+      length, = _length.unpack_from(self._buffer)
+      if len(self._buffer) < _length.size + length: break
+      messages.append(json.loads(self._buffer[_length.size:_length.size + length].decode()))
+      del self._buffer[:_length.size + length]
+    return messages
+
+class TelemetryPublisher(object):
+  """
+  Sends events to a monitor from a background thread.
+    `publish' only appends to a bounded deque, so it never blocks the kivy loop. When the monitor is slow or missing
+    the deque fills up and the oldest events are dropped. The thread reconnects every `retry_interval' seconds.
+  """
+
+  def __init__(self, address, booth, capacity=4096, retry_interval=2.0, send_timeout=1.0):
+    self._family, self._address = parse_address(address)
+    self._booth = booth
+    self._events = deque(maxlen=capacity)
+    self._retry_interval = retry_interval
+    self._send_timeout = send_timeout
+    self._wake = threading.Event()
+    self._stopping = False
+    self._socket = None
+    self.published = 0
+    self.sent = 0
+    self.dropped = 0 # dropped from a full queue or lost with a broken connection
+    self._thread = threading.Thread(target=self._run, name="telemetry-publisher")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def publish(self, event, **fields):
+    if len(self._events) == self._events.maxlen:
+      self.dropped += 1
+    fields.update(booth=self._booth, event=event, time=time.time())
+    self._events.append(fields)
+    self.published += 1
+    self._wake.set()
+
+  def close(self, timeout=2.0):
+    # sends what's queued if the monitor is there, for up to `timeout' seconds
+    self._stopping = True
+    self._wake.set()
+    self._thread.join(timeout)
+
+  def get_stats(self):
+    return {"published": self.published, "sent": self.sent, "dropped": self.dropped, "queued": len(self._events),
+            "connected": self._socket is not None}
+
+  def _run(self):
+    while True:
+      self._wake.wait(self._retry_interval)
+      self._wake.clear()
+      if self._socket is None and not self._connect():
+        if self._stopping: break
+        continue
+      while self._events:
+        frame = encode_frame(self._events.popleft())
+        try:
+          self._socket.sendall(frame)
+          self.sent += 1
+        except OSError:
+          self.dropped += 1
+          self._disconnect()
+          break
+      if self._stopping: break
+    self._disconnect()
+
+  def _connect(self):
+    connection = socket.socket(self._family, socket.SOCK_STREAM)
+    connection.settimeout(self._send_timeout)
+    try:
+      connection.connect(self._address)
+    except OSError:
+      connection.close()
+      return False
+    self._socket = connection
+    return True
+
+  def _disconnect(self):
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+
+class TelemetrySubscriber(object):
+  """
+  Listens for booths and calls `on_message(message)' for every event they send, from `serve_forever''s thread.
+  """
+
+  def __init__(self, address, on_message):
+    family, self._address = parse_address(address)
+    self._on_message = on_message
+    self._listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+      self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._listener.bind(self._address)
+    self._listener.listen(16)
+    self._listener.setblocking(False)
+    self._selector = selectors.DefaultSelector()
+    self._selector.register(self._listener, selectors.EVENT_READ)
+    self._running = True
+
+  @property
+  def address(self):
+    return self._listener.getsockname()
+
+  def serve_forever(self, poll_interval=0.5):
+    while self._running:
+      for key, _ in self._selector.select(poll_interval):
+        if key.fileobj is self._listener:
+          connection, _ = self._listener.accept()
+          connection.setblocking(False)
+          self._selector.register(connection, selectors.EVENT_READ, FrameDecoder())
+          continue
+        try:
+          data = key.fileobj.recv(65536)
+        except OSError:
+          data = b""
+        if not data:
+          self._selector.unregister(key.fileobj)
+          key.fileobj.close()
+          continue
+        for message in key.data.feed(data):
+          self._on_message(message)
+    for key in list(self._selector.get_map().values()):
+      key.fileobj.close()
+    self._selector.close()
+
+  def shutdown(self):
+    self._running = False
+
+def _print_message(message):
+  fields = ", ".join("{}={}".format(key, value) for key, value in sorted(message.items())
+                     if key not in ("booth", "event", "time"))
+  print("{} {:<10} {:<10} {}".format(time.strftime("%H:%M:%S", time.localtime(message["time"])), message["booth"],
+                                     message["event"], fields))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Watch the trial events of PriMate booths")
+  parser.add_argument("address", nargs="?", default=default_address)
+  args = parser.parse_args()
+  subscriber = TelemetrySubscriber(args.address, _print_message)
+  print("listening on {}".format(args.address))
+  try:
+    subscriber.serve_forever()
+  except KeyboardInterrupt:
+    pass
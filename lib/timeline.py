@@ -0,0 +1,79 @@
+__author__ = 'Mohammed Hamdy'
+
+from functools import partial
+from lib import timing
+
+class TimelineEvent(object):
+
+  def __init__(self, trial_index, name, planned, callback):
+    self.trial_index = trial_index
+    self.name = name
+    self.planned = planned # seconds after the anchor
+    self.actual = None # seconds after the anchor, once it ran
+    self.callback = callback
+
+  @property
+  def error(self):
+    # how late the event ran, in seconds
+    return self.actual - self.planned
+
+class TrialTimeline(object):
+  """
+  Runs the events of a trial at fixed offsets from a single anchor time.
+    Every event is scheduled against the anchor rather than after the previous event, so scheduling delays
+    don't add up along the trial. An event woken up early is put back to sleep for the rest of its wait.
+    `on_event_done(event)' is called after each event ran, with its planned and actual offsets filled in.
+  """
+
+  # events woken up earlier than this are rescheduled
+  _early_tolerance = 0.001
+
+  def __init__(self, clock, now=timing.now, on_event_done=None):
+    self._clock = clock
+    self._now = now
+    self._on_event_done = on_event_done
+    self._anchor = None
+    self._trial_index = None
+    self.event_count = 0
+    self.total_abs_error = 0.
+    self.max_abs_error = 0.
+
+  def start(self, trial_index):
+    self._anchor = self._now()
+    self._trial_index = trial_index
+
+  def plan(self, name, offset, callback):
+    event = TimelineEvent(self._trial_index, name, offset, callback)
+    self._schedule(event)
+    return event
+
+  def get_jitter_summary(self):
+    # milliseconds, over every event run so far
+    if self.event_count == 0:
+      return {"events": 0}
+    return {"events": self.event_count, "mean_abs_error_ms": self.total_abs_error / self.event_count * 1000,
+            "max_abs_error_ms": self.max_abs_error * 1000}
+
+  def _schedule(self, event, anchor=None):
+    anchor = self._anchor if anchor is None else anchor
+    delay = anchor + event.planned - self._now()
+    if delay <= 0:
+      self._run(event, anchor)
+    else:
+      self._clock.schedule_once(partial(self._wake, event, anchor), delay)
+
+  def _wake(self, event, anchor, elapsed):
+    if anchor + event.planned - self._now() > self._early_tolerance:
+      self._schedule(event, anchor)
+    else:
+      self._run(event, anchor)
+
+  def _run(self, event, anchor):
+    event.actual = self._now() - anchor
+    abs_error = abs(event.error)
+    self.event_count += 1
+    self.total_abs_error += abs_error
+    self.max_abs_error = max(self.max_abs_error, abs_error)
+    event.callback()
+    if self._on_event_done is not None:
+      self._on_event_done(event)
@@ -0,0 +1,60 @@
+__author__ = 'Mohammed Hamdy'
+
+import time
+
+# all trial timing uses this monotonic high resolution clock (seconds). it doesn't jump with NTP or daylight saving
+now = time.perf_counter
+
+def touch_event_time(touch):
+  """
+  Returns when a touch happened on the `now' clock, and how long ago that was.
+    Kivy stamps touches with the wall clock when it reads them from the input provider, so the age of the touch
+    is measured on the wall clock (a short interval, unaffected by slow clock corrections) and moved to `now'.
+  """
+  handled_time = now()
+  age = max(0, time.time() - touch.time_start)
+  return handled_time - age, age
+
+class ChoiceTiming(object):
+  """
+  Timing of a card choice. All values are in seconds.
+    time_till_choice: from the first presented trial frame to the touch event
+    time_till_handled: from the first presented trial frame to the choice handler running
+    touch_delay: from the touch event to the choice handler running
+    onset_delay: from switching to the trial screen to its first presented frame
+  """
+
+  def __init__(self, trial_start_time, touch_time, handled_time, onset_delay):
+    self.time_till_choice = touch_time - trial_start_time
+    self.time_till_handled = handled_time - trial_start_time
+    self.touch_delay = handled_time - touch_time
+    self.onset_delay = onset_delay
+
+class StartupProfile(object):
+  """
+  Time spent in each startup phase. `mark(phase)' ends a phase: it gets the time since the previous mark.
+    Work done later, between frames, is timed by itself and added with `add(phase, seconds)'. It's reported after
+    the total, which only covers the marked phases.
+  """
+
+  def __init__(self):
+    self._last_mark_time = self._start_time = now()
+    self.phases = []
+    self.later_phases = []
+
+  def mark(self, phase):
+    mark_time = now()
+    self.phases.append((phase, mark_time - self._last_mark_time))
+    self._last_mark_time = mark_time
+
+  def add(self, phase, seconds):
+    self.later_phases.append((phase, seconds))
+
+  def report(self):
+    lines = ["{:<28}{:>8.1f} ms".format(phase, seconds * 1000) for phase, seconds in self.phases]
+    lines.append("{:<28}{:>8.1f} ms".format("total", (self._last_mark_time - self._start_time) * 1000))
+    lines.extend("{:<28}{:>8.1f} ms".format(phase, seconds * 1000) for phase, seconds in self.later_phases)
+    return "\n".join(lines)
+
+# started when PriMate is first imported
+startup_profile = StartupProfile()
@@ -0,0 +1,77 @@
+__author__ = 'Mohammed Hamdy'
+
+import struct, threading
+
+# one record per touch: timestamp on the timing.now() clock (seconds), x, y (window pixels), target slot, trial index
+_record_format = struct.Struct("<dffhh")
+record_size = _record_format.size
+
+# target slots. image slots are numbered 1 to 7 like their ids in screens.kv
+SLOT_UNKNOWN = -1
+SLOT_BACKGROUND = 0
+SLOT_VIDEO = 8
+
+class TouchRecorder(object):
+  """
+  Records every touch of a session into a preallocated ring buffer and flushes it to a binary file from a background thread.
+    `record' only packs a record into the buffer, so it's cheap enough for the touch path.
+    If the flusher falls a whole buffer behind, the oldest unflushed records are overwritten and counted in `overrun_count'.
+  """
+
+  def __init__(self, path, capacity=4096, flush_interval=1.0):
+    self._path = path
+    self._capacity = capacity
+    self._buffer = bytearray(capacity * record_size)
+    self._write_count = 0 # records written into the buffer so far
+    self._flush_count = 0 # records flushed to the file so far
+    self._flush_interval = flush_interval
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._file = open(path, 'ab')
+    self.overrun_count = 0
+    self.trial_index = -1
+    self._thread = threading.Thread(target=self._run, name="touch-recorder")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def record(self, timestamp, x, y, slot):
+    with self._lock:
+      _record_format.pack_into(self._buffer, (self._write_count % self._capacity) * record_size,
+                               timestamp, x, y, slot, self.trial_index)
+      self._write_count += 1
+
+  def close(self):
+    if self._thread is None: return
+    self._stop_event.set()
+    self._thread.join()
+    self._thread = None
+    self._flush()
+    self._file.close()
+
+  def _run(self):
+    while not self._stop_event.wait(self._flush_interval):
+      self._flush()
+
+  def _flush(self):
+    with self._lock:
+      write_count = self._write_count
+      if write_count - self._flush_count > self._capacity:
+        self.overrun_count += write_count - self._flush_count - self._capacity
+        self._flush_count = write_count - self._capacity
+      start = self._flush_count % self._capacity
+      end = start + write_count - self._flush_count
+      if end <= self._capacity:
+        data = bytes(self._buffer[start * record_size:end * record_size])
+      else:
+        data = bytes(self._buffer[start * record_size:]) + bytes(self._buffer[:(end - self._capacity) * record_size])
+      self._flush_count = write_count
+    if data:
+      self._file.write(data)
+      self._file.flush()
+
+def load_touch_stream(path):
+  # returns the recorded touches as a dict of numpy arrays: timestamp, x, y, slot, trial_index
+  import numpy
+  dtype = numpy.dtype([("timestamp", "<f8"), ("x", "<f4"), ("y", "<f4"), ("slot", "<i2"), ("trial_index", "<i2")])
+  records = numpy.fromfile(path, dtype=dtype)
+  return dict((name, records[name]) for name in dtype.names)
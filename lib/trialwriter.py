@@ -0,0 +1,165 @@
+__author__ = 'Mohammed Hamdy'
+
+import csv, logging, os, threading, time
+from queue import Queue, Empty
+
+# kivy's Logger is the "kivy" logger of the logging module. getting it by name keeps this module free of kivy
+Logger = logging.getLogger("kivy")
+
+class TrialDataWriter(object):
+  """
+  Writes trial rows to the stats csv files from a background thread.
+    Files are kept open between rows. When rows reach the disk is decided by the flush policy:
+      flush_every_rows: flush after this many rows (1 means every row)
+      flush_interval_ms: flush pending rows at least this often, whatever their count
+      fsync: also ask the OS to commit flushed rows to the disk
+    A file that can't be opened or written, like a csv left open in Excel or a full disk, is retried every
+    `retry_interval' seconds. Its row, and everything queued after it, waits meanwhile, so no row is lost.
+  """
+
+  retry_interval = 1.0
+
+  def __init__(self, flush_every_rows=1, flush_interval_ms=None, fsync=False):
+    self._flush_every_rows = max(1, flush_every_rows)
+    self._flush_interval = flush_interval_ms / 1000.0 if flush_interval_ms else None
+    self._fsync = fsync
+    self._queue = Queue()
+    self._files = {} # path -> (file, csv writer)
+    self._pending_rows = 0
+    self._last_flush = time.monotonic()
+    self._flush_failed = False
+    self._closing = False
+    self._thread = threading.Thread(target=self._run, name="trial-data-writer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def start_file(self, path, header):
+    # truncate the file and write its header row
+    self._queue.put(("start", path, header))
+
+  def ensure_header(self, path, header):
+    # files started with fewer columns than `header' get it written over their first line. rows stay as they are
+    self._queue.put(("header", path, header))
+
+  def write_row(self, path, row):
+    self._queue.put(("row", path, row))
+
+  def flush(self):
+    self._queue.put(("flush", None, None))
+
+  def close(self):
+    # drain everything queued so far, then close all files
+    if self._thread is None: return
+    # rows that still can't be written by now are dropped, so closing never hangs
+    self._closing = True
+    self._queue.put(("close", None, None))
+    self._thread.join()
+    self._thread = None
+
+  def _run(self):
+    failed_action = None
+    while True:
+      if failed_action is not None:
+        action = failed_action
+      else:
+        try:
+          action = self._queue.get(timeout=self._get_wait_timeout())
+        except Empty:
+          self._flush_files()
+          continue
+      try:
+        if self._do(*action):
+          return
+      except OSError as e:
+        if self._closing:
+          Logger.error("TrialDataWriter: dropped a {} for {}: {}".format(action[0], action[1], e))
+          failed_action = None
+        else:
+          if failed_action is None:
+            Logger.error("TrialDataWriter: {} failed for {}, retrying every {} s: {}"
+                         .format(action[0], action[1], self.retry_interval, e))
+          failed_action = action
+          time.sleep(self.retry_interval)
+        continue
+      except Exception:
+        # a row that can never be written, like one the csv module refuses. the thread has to outlive it
+        Logger.exception("TrialDataWriter: dropped a {} for {}".format(action[0], action[1]))
+        failed_action = None
+        continue
+      if failed_action is not None:
+        Logger.info("TrialDataWriter: {} is writable again".format(failed_action[1]))
+        failed_action = None
+
+  def _do(self, action, path, data):
+    # returns True once closed
+    if action == "start":
+      self._close_file(path)
+      self._get_writer(path, 'w').writerow(data)
+      self._flush_files()
+    elif action == "header":
+      self._upgrade_header(path, data)
+    elif action == "row":
+      self._get_writer(path, 'a').writerow(data)
+      self._pending_rows += 1
+      if self._pending_rows >= self._flush_every_rows or self._flush_due():
+        self._flush_files()
+    elif action == "flush":
+      self._flush_files()
+    elif action == "close":
+      self._flush_files()
+      for path in list(self._files):
+        try:
+          self._close_file(path)
+        except OSError as e:
+          Logger.error("TrialDataWriter: could not close {}: {}".format(path, e))
+      return True
+    return False
+
+  def _upgrade_header(self, path, header):
+    if not os.path.exists(path): return
+    with open(path, 'r', newline='') as stats_reader:
+      lines = stats_reader.readlines()
+    if lines and len(next(csv.reader(lines[:1]))) >= len(header): return
+    self._close_file(path)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', newline='') as stats_writer:
+      csv.writer(stats_writer).writerow(header)
+      stats_writer.writelines(lines[1:])
+    os.replace(temp_path, path)
+
+  def _get_wait_timeout(self):
+    # only wake up on a timer when there are rows waiting for the interval flush, or a failed flush to retry
+    if self._flush_failed:
+      return self.retry_interval
+    if self._pending_rows == 0 or self._flush_interval is None:
+      return None
+    return max(0, self._last_flush + self._flush_interval - time.monotonic())
+
+  def _flush_due(self):
+    return self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval
+
+  def _get_writer(self, path, mode):
+    if path not in self._files:
+      stats_file = open(path, mode, newline='')
+      self._files[path] = (stats_file, csv.writer(stats_file))
+    return self._files[path][1]
+
+  def _flush_files(self):
+    # rows that didn't reach the disk stay in the file's buffer for the next flush
+    flush_failed = False
+    for path, (stats_file, _) in self._files.items():
+      try:
+        stats_file.flush()
+        if self._fsync:
+          os.fsync(stats_file.fileno())
+      except OSError as e:
+        if not self._flush_failed:
+          Logger.error("TrialDataWriter: could not flush {}, retrying: {}".format(path, e))
+        flush_failed = True
+    self._flush_failed = flush_failed
+    self._pending_rows = 0
+    self._last_flush = time.monotonic()
+
+  def _close_file(self, path):
+    if path in self._files:
+      self._files.pop(path)[0].close()
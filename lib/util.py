@@ -1,15 +1,10 @@
 __author__ = 'Mohammed Hamdy'
 
 from os.path import dirname, join, splitext, basename
-from os import listdir
+from os import listdir, replace
 from datetime import datetime
-import json, subprocess
-
-_config_dir = join(dirname(dirname(__file__)), "config")
-
-def dispense_pellet():
-  batch_despenser = join(_config_dir, "dispenser.bat")
-  subprocess.Popen(batch_despenser)
+import json
+from lib.journal import ProgressJournal, apply_journal_record
 
 def get_video_dir():
   return join(dirname(dirname(__file__)), "res", "videos")
@@ -20,116 +15,180 @@ def get_images_dir():
 def get_background_placeholder():
   return join(get_images_dir(), "placeholder.png")
 
+def get_trial_image_paths():
+  # every image a trial screen may show, for preloading
+  image_names = set(name for names in Condition._associated_images.values() for name in names)
+  return [join(get_images_dir(), image_name) for image_name in sorted(image_names)] + [get_background_placeholder()]
+
 class SubjectManager(object):
   """
   Keeps track of subjects and conditions in `subjects.json'.
     Like which conditions has been run for each subject.
+    Progress is appended to `subjects.journal' after every change and compacted into `subjects.json' periodically.
   """
 
   _default_conditions = [{"name":"high_ranking"}, {"name":"low_ranking"}, {"name":"nonsocial"}, {"name":"stranger"}]
+  # fold the journal back into subjects.json after this many records
+  _journal_compact_every = 500
 
-  def __init__(self, total_trial_count):
+  def __init__(self, total_trial_count, subjects_file_path=None, video_dir=None):
     self._total_trial_count = total_trial_count
-    self._subjects_file_path = join(dirname(dirname(__file__)), "config", "subjects.json")
-    dir_conditions = get_video_dir()
-    self._full_path_videos = [join(dir_conditions, video_name) for video_name in listdir(dir_conditions)]
-    self._subject_infos = json.load(open(self._subjects_file_path, 'r', newline=''))
+    self._subjects_file_path = subjects_file_path or join(dirname(dirname(__file__)), "config", "subjects.json")
+    dir_conditions = video_dir or get_video_dir()
+    # condition name -> video path. a condition is named after its video file, without the extension
+    self._video_by_condition = {}
+    for video_name in sorted(listdir(dir_conditions)):
+      self._video_by_condition.setdefault(splitext(video_name)[0], join(dir_conditions, video_name))
+    self._condition_cache = {} # condition name -> Condition, used for lists of conditions
+    with open(self._subjects_file_path, 'r', newline='') as subjects_reader:
+      self._subject_infos = json.load(subjects_reader)
+    self._subject_index = {}
+    for subject_info in self._subject_infos:
+      self._subject_index.setdefault(subject_info["name"], subject_info)
+    self._condition_index = {} # subject -> {condition name -> condition dict}
+    self._playable_cache = {} # subject -> list of playable Condition, invalidated by progress changes
+    self._status_cache = {} # subject -> SubjectStatus, updated as trials pass and dropped when conditions change
+    self._journal = ProgressJournal(splitext(self._subjects_file_path)[0] + ".journal")
+    self._replay_journal()
 
   def get_subjects(self):
     return [subject["name"] for subject in self._subject_infos]
 
   def get_conditions(self, subject):
     subject_info = self._get_subject_info(subject)
-    video_paths = []
     conditions = subject_info.get("conditions", []) # user might add new subjects with only a name to subjects.json
-    condition_names = [condition["name"] for condition in conditions]
-    for condition_name in condition_names:
-      for condition_video in self._full_path_videos:
-        if condition_name in condition_video:
-          video_paths.append(condition_video)
-    return [Condition(video_path) for video_path in video_paths]
+    return [self._get_condition(condition["name"]) for condition in conditions
+            if condition["name"] in self._video_by_condition]
 
   def is_subject_done(self, subject):
-    subject_info  = self._get_subject_info(subject)
-    return len(self._get_playable_conditions(subject_info)) == 0
+    return len(self._get_playable_conditions(subject)) == 0
+
+  def get_subject_status(self, subject):
+    if subject not in self._status_cache:
+      self._status_cache[subject] = self._get_subject_status(subject)
+    return self._status_cache[subject]
 
-  def _get_played_conditions(self, subject_info):
-    return list(filter(lambda condition: condition.get("played", False), subject_info.get("conditions", [])))
+  def get_subject_statuses(self):
+    # in subjects.json order. only subjects that changed since the last call are recomputed
+    return [self.get_subject_status(subject) for subject in self.get_subjects()]
 
   def get_unfinished_condition(self, subject):
     # assign a condition to the subject in the order specified in subjects.json
     # this assumes that the caller knows what it's doing. it won't check if there's no conditions left
     subject_info = self._get_subject_info(subject)
-    playable_conditions = self._get_playable_conditions(subject_info)
-    played_conditions = self._get_played_conditions(subject_info)
-    target_condition = playable_conditions[0]  # choose highest priority (last_played) or just first
-    condition_video_path = target_condition.video
+    target_condition = self._get_playable_conditions(subject)[0]  # choose highest priority (last_played) or just first
     # read the existing trial index or zero out
     target_condition_name = target_condition.condition_name
-    for condition in played_conditions:
-      if condition["name"] == target_condition_name:
-        next_trial_index = condition["next_trial_index"]
-        break
+    condition_info = self._get_condition_info(subject_info, target_condition_name)
+    if condition_info.get("played", False):
+      next_trial_index = condition_info["next_trial_index"]
     else:
       next_trial_index = 0
     # the last_played property should only exist for a single condition
     # update the played condition
-    self._update_condition_dict(subject_info, target_condition.condition_name,
-                                {"next_trial_index": next_trial_index, "last_played": True, "played":True})
-    return Condition(condition_video_path, next_trial_index)
+    progress = {"next_trial_index": next_trial_index, "last_played": True, "played":True}
+    self._update_condition_dict(subject_info, target_condition_name, progress)
+    self._journal_change(subject, target_condition_name, progress)
+    return Condition(target_condition.video, next_trial_index)
 
   def passed_trial(self, subject, condition):
     # should be called whenever a subject passes a trial
     subject_info = self._get_subject_info(subject)
     condition_info = self._get_condition_info(subject_info, condition.condition_name)
     condition_info["next_trial_index"] += 1
+    deleted = []
     # remove resumption possibility from condition when it's finished
     if condition_info["next_trial_index"] == self._total_trial_count:
       condition_info.pop("last_played", None)
+      deleted.append("last_played")
+      # only finishing a condition changes what's playable
+      self._playable_cache.pop(subject, None)
+      self._status_cache.pop(subject, None)
+    elif subject in self._status_cache:
+      self._status_cache[subject].trials_remaining -= 1
+    self._journal_change(subject, condition.condition_name, {"next_trial_index": condition_info["next_trial_index"]}, deleted)
 
   def save(self):
-    # this should be called at the end of each condition (200 trials)
-    with open(self._subjects_file_path, 'w', newline='') as subjects_writer:
+    # this should be called at the end of each condition (200 trials). the journal is emptied once the save is done
+    temp_file_path = self._subjects_file_path + ".tmp"
+    with open(temp_file_path, 'w', newline='') as subjects_writer:
       json.dump(self._subject_infos, subjects_writer, indent=2)
+    replace(temp_file_path, self._subjects_file_path)
+    self._journal.reset()
+
+  def _journal_change(self, subject, condition_name, updated, deleted=None):
+    self._journal.append(subject, condition_name, updated, deleted)
+    if self._journal.record_count >= self._journal_compact_every:
+      self.save()
+
+  def _replay_journal(self):
+    records = self._journal.replay()
+    for record in records:
+      subject_info = self._get_subject_info(record["s"])
+      if subject_info is None: continue # subject removed from subjects.json by hand
+      apply_journal_record(self._get_condition_info(subject_info, record["c"]), record)
+      self._playable_cache.pop(record["s"], None)
+      self._status_cache.pop(record["s"], None)
+    if records:
+      self.save()
 
   def _get_subject_info(self, subject):
-    for subject_info in self._subject_infos:
-      if subject_info["name"] == subject:
-        return subject_info
+    return self._subject_index.get(subject)
 
-  def _get_playable_conditions(self, subject_info):
+  def _get_condition(self, condition_name):
+    # conditions in playable lists are shared. get_unfinished_condition hands out its own copy
+    if condition_name not in self._condition_cache:
+      self._condition_cache[condition_name] = Condition(self._video_by_condition[condition_name])
+    return self._condition_cache[condition_name]
+
+  def _get_playable_conditions(self, subject):
     # playable conditions are conditions never before played or has a trial index less than total trial count
-    # this returns the list of video names that can be played
+    # this returns the list of conditions that can be played
+    if subject in self._playable_cache:
+      return self._playable_cache[subject]
+    subject_info = self._get_subject_info(subject)
     playable_conditions = []
-    # first add never before played conditions
-    subject_played_condition_names = [condition["name"] for condition in self._get_played_conditions(subject_info)]
-    for condition in subject_info.get("conditions"):
-      condition_name = condition["name"]
-      full_path_video = self._video_from_condition_name(condition_name)
-      if condition_name in subject_played_condition_names:
+    # a subject with only a name gets the default conditions once it starts a trial
+    conditions = subject_info.get("conditions", self._default_conditions)
+    for condition in conditions:
+      condition_video = self._get_condition(condition["name"])
+      if condition.get("played", False):
         next_trial_index = condition.get("next_trial_index", 0)
         last_played = condition.get("last_played", False)
         if next_trial_index < self._total_trial_count:
-          playable_conditions.append(full_path_video)
+          playable_conditions.append(condition_video)
         elif last_played:
           # give last played condition a priority by inserting it first into playable conditions
-          playable_conditions.insert(0, full_path_video)
+          playable_conditions.insert(0, condition_video)
       else:
         # never before played condition
-        playable_conditions.append(full_path_video)
-    return [Condition(video_path) for video_path in playable_conditions]
+        playable_conditions.append(condition_video)
+    self._playable_cache[subject] = playable_conditions
+    return playable_conditions
+
+  def _get_subject_status(self, subject):
+    playable_conditions = self._get_playable_conditions(subject)
+    subject_info = self._get_subject_info(subject)
+    next_trial_indexes = dict((condition["name"], condition.get("next_trial_index", 0) if condition.get("played") else 0)
+                              for condition in subject_info.get("conditions", self._default_conditions))
+    trials_remaining = sum(max(0, self._total_trial_count - next_trial_indexes.get(condition.condition_name, 0))
+                           for condition in playable_conditions)
+    next_condition = playable_conditions[0].name if playable_conditions else None
+    return SubjectStatus(subject, trials_remaining, next_condition)
 
   def _update_condition_dict(self, subject_info, condition_name, props):
     target_dict = self._get_condition_info(subject_info, condition_name)
     target_dict.update(props)
+    self._playable_cache.pop(subject_info["name"], None)
+    self._status_cache.pop(subject_info["name"], None)
 
   def _get_condition_info(self, subject_info, condition_name):
-    subject_info.setdefault("conditions", self._default_conditions)
-    return [condition_dict for condition_dict in subject_info.get("conditions") if
-            condition_dict["name"] == condition_name][0]
-
-  def _video_from_condition_name(self, condition_name):
-    return [video_path for video_path in self._full_path_videos if condition_name in video_path][0]
+    subject = subject_info["name"]
+    if subject not in self._condition_index:
+      if "conditions" not in subject_info:
+        subject_info["conditions"] = [dict(condition) for condition in self._default_conditions]
+      self._condition_index[subject] = dict((condition["name"], condition) for condition in subject_info["conditions"])
+    return self._condition_index[subject][condition_name]
 
 
 def variablize_string(s):
@@ -145,17 +204,41 @@ class Condition(object):
     self.video = video
     self.next_trial_index = next_trial_index
 
+  # each condition has 2 associated images
+  _associated_images = {"high_ranking": ("bluecogs.png", "purpleleaf.png"),
+                        "low_ranking": ("redwhitesquares.png", "irishgreen.png"),
+                        "stranger": ("greenbrownleaves.png", "moon.png"),
+                        "nonsocial": ("purplediamond.png", "snowflake.png")}
+
   def get_associated_images(self):
-    # each condition has 2 associated images.
+    image_names = self._associated_images.get(self.condition_name)
+    if image_names is None: return None
     image_dir = get_images_dir()
-    if "high_ranking" in self.video:
-      return {"left_image":join(image_dir, "bluecogs.png"), "right_image":join(image_dir, "purpleleaf.png")}
-    elif "low_ranking" in self.video:
-      return {"left_image":join(image_dir, "redwhitesquares.png"), "right_image":join(image_dir, "irishgreen.png")}
-    elif "stranger" in self.video:
-      return {"left_image":join(image_dir, "greenbrownleaves.png"), "right_image":join(image_dir, "moon.png")}
-    elif "nonsocial" in self.video:
-      return {"left_image":join(image_dir, "purplediamond.png"), "right_image":join(image_dir, "snowflake.png")}
+    return {"left_image":join(image_dir, image_names[0]), "right_image":join(image_dir, image_names[1])}
+
+class SubjectStatus(object):
+  # what the subject screen shows for a subject
+
+  def __init__(self, subject, trials_remaining, next_condition, running_in=None):
+    self.subject = subject
+    self.trials_remaining = trials_remaining
+    self.next_condition = next_condition # display name, None once all conditions are done
+    self.running_in = running_in # the booth running the subject, when run by lib.booths
+
+  @property
+  def done(self):
+    return self.next_condition is None
+
+  @property
+  def available(self):
+    return not self.done and self.running_in is None
+
+  def describe(self):
+    if self.done:
+      return "{}: done".format(self.subject)
+    if self.running_in is not None:
+      return "{}: running in {}".format(self.subject, self.running_in)
+    return "{}: {}, {} trials left".format(self.subject, self.next_condition, self.trials_remaining)
 
 class TrialData(object):
 
@@ -168,6 +251,13 @@ class TrialData(object):
     self.trial_index = trial_index
     self.background_touches = 0
     self.video_touches = 0
-    self.time_till_selection = None
+    self.time_till_selection = None # seconds from the first presented trial frame to the choice touch
+    self.time_till_selection_handled = None # same, but till the choice was handled
+    self.touch_delay = None # milliseconds from the choice touch till it was handled
+    self.trial_onset_delay = None # milliseconds from entering the trial screen till its first frame
     self.card_selected = None
-    self.pellets_dispensed = 0
\ No newline at end of file
+    self.pellets_dispensed = 0 # paid out by the payoff schedule
+    self.pellets_delivered = 0 # of those, the ones the dispenser got the command for
+    self.video_first_frame_latency = None # milliseconds
+    self.video_late_frames = 0
+    self.video_dropped_frames = 0
\ No newline at end of file
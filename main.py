@@ -1,40 +1,81 @@
 __author__ = 'Mohammed Hamdy'
 
-from os.path import dirname, join
-import csv, random
+from os.path import dirname, join, abspath
+import os, random, subprocess, sys, threading
 from functools import partial
 from datetime import datetime
+from lib.timing import startup_profile
 from kivy.app import App
 from kivy.lang import Builder
 from kivy.uix.widget import Widget
 from kivy.uix.screenmanager import ScreenManager, Screen, NoTransition
 from kivy.uix.button import Button
+from kivy.uix.listview import ListView, SelectableView
+from kivy.adapters.listadapter import ListAdapter
+from kivy.properties import StringProperty, ObjectProperty
 from kivy.uix.video import Video
 from kivy.uix.image import Image
 from kivy.clock import Clock
 from kivy.core.window import Window
-from lib.util import dispense_pellet, SubjectManager, TrialData, variablize_string, get_background_placeholder
+from kivy.logger import Logger
+from lib.dispenser import PelletDispenser
+from lib.trialwriter import TrialDataWriter
+from lib.payoff import PayoffSchedules
+from lib import timing
+from lib.touchlog import TouchRecorder, SLOT_BACKGROUND, SLOT_VIDEO
+from lib.session import TrialSession
+from lib.assets import AssetCache, get_asset_paths
+from lib.memprofile import MemoryProfiler
+from lib.telemetry import TelemetryPublisher
+from lib.metrics import MetricsRegistry, InstrumentedClock
+from lib.booths import SubjectClaimedError
+from lib.util import SubjectManager, variablize_string, get_background_placeholder, get_trial_image_paths
 from ui.mixins import CustomTouchWidgetMixin
+from ui.textures import TextureCache
+from ui.video import ConditionVideoManager
+from ui.instrumentation import UiInstrumentation
 
-class SubjectButton(Button):
-  pass
+startup_profile.mark("imports")
+
+class SubjectButton(SelectableView, Button):
+  # a row of the subject list. SelectableView gives it the index the list adapter passes in
+  subject = StringProperty()
+  screen = ObjectProperty(None)
+
+  def on_press(self):
+    self.screen.handle_subject_selected(self)
 
 class SubjectScreen(Screen):
+  """
+  Lists the subjects with their next condition and trials left, filtered by the search box.
+    The list only creates buttons for the rows in view, and the statuses are cached by the subject manager,
+    so the screen shows up instantly with hundreds of subjects.
+  """
 
   def __init__(self, subject_reader, *args, **kwargs):
     super(SubjectScreen, self).__init__(*args, **kwargs)
     # emit an event when a subject button is pressed
     self.register_event_type("on_subject_selected")
-    # fill out the subjects screen from subjects.json
-    subject_container = self.ids.subject_container
-    name_config_file = join(dirname(__file__), "config", "subjects.json")
-    for subject in subject_reader.get_subjects():
-      button_subject = SubjectButton(text=subject)
-      if subject_reader.is_subject_done(subject):
-        button_subject.disabled = True
-      else:
-        button_subject.bind(on_press=self.handle_subject_selected)
-      subject_container.add_widget(button_subject)
+    self._subject_reader = subject_reader
+    self._statuses = []
+    self._filter_text = ""
+    self._adapter = ListAdapter(data=[], cls=SubjectButton, args_converter=self._get_button_args,
+                                selection_mode="none", allow_empty_selection=True)
+    self.ids.subject_container.add_widget(ListView(adapter=self._adapter))
+    self.refresh()
+
+  def refresh(self):
+    # re-read the statuses, like after a condition ended
+    self._statuses = self._subject_reader.get_subject_statuses()
+    self.filter_subjects(self._filter_text)
+
+  def filter_subjects(self, text):
+    # called from kv as the search text changes
+    self._filter_text = text.strip().lower()
+    self._adapter.data = [status for status in self._statuses if self._filter_text in status.subject.lower()]
+
+  def _get_button_args(self, row_index, status):
+    return {"subject": status.subject, "text": status.describe(), "disabled": not status.available, "screen": self}
 
   def handle_subject_selected(self, button):
     self.dispatch("on_subject_selected", button)
@@ -65,51 +106,134 @@ class TrialScreen(Screen):
     self._video_touches = 0
     self._background_touches = 0
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self, texture_cache, get_asset_path, *args, **kwargs):
     super(TrialScreen, self).__init__(*args, **kwargs)
+    self._texture_cache = texture_cache
+    self._get_asset_path = get_asset_path
     self.register_event_type("on_left_card_chosen")
     self.register_event_type("on_right_card_chosen")
     self._init_touch_count()
+    # trial start is when the first frame after entering the screen was presented, on the timing.now() clock.
+    # cards can't be chosen before it's known
     self._trial_start_time = None
+    self._entered = False
+    self._trial_enter_time = None
     self._condition = None
     self._image_left_card = None
     self._image_right_card = None
     # a workaround for multiple card touch detections in trial screen
     self._got_card_touch = False
+    # time from on_pre_enter till the first frame drawn after entering the screen
+    self._pre_enter_time = None
+    self._awaiting_first_frame = False
+    self.last_frame_ready_latency = None
+    Window.bind(on_flip=self._on_window_flip)
+    self._video_manager = ConditionVideoManager(self.ids.video_condition)
+    self._video_stats = None
+    # every touch goes to the touch recorder, when there's one, before any trial handler sees it
+    self._touch_recorder = None
+    self._telemetry = None
+    touch_slots = [(self.ids.background_left, SLOT_BACKGROUND), (self.ids.background_right, SLOT_BACKGROUND),
+                   (self.ids.video_condition, SLOT_VIDEO)]
+    touch_slots.extend((image_place, slot) for slot, image_place in enumerate(self._get_image_places(), 1))
+    for widget, slot in touch_slots:
+      widget.bind(on_really_touch_down=partial(self._record_touch, slot))
+    # image slots are bound once. what a touch on a slot means is looked up from the roles assigned each trial
+    self._slot_roles = {}
+    self._role_handlers = {"left_card": self.left_card_selected, "right_card": self.right_card_selected,
+                           "background": self.on_background_touched}
+    for image_place in self._get_image_places():
+      image_place.bind(on_really_touch_down=self._on_image_place_touched)
+    # hit test rectangles of the touch widgets in screen coordinates, recomputed only when the layout changes
+    self._touch_widgets = [widget for widget, _ in touch_slots]
+    self._touch_geometry = None
+    for widget in self._touch_widgets:
+      widget.bind(pos=self._invalidate_touch_geometry, size=self._invalidate_touch_geometry)
 
   def left_card_selected(self, image, touch):
-    if self._got_card_touch: return
+    if self._got_card_touch or self._trial_start_time is None: return
     self._enable_cards(False)
     self._image_right_card.opacity = 0
-    self.dispatch("on_left_card_chosen", self._calculate_time_till_choice())
+    self._video_stats = self._video_manager.end_trial()
+    self.dispatch("on_left_card_chosen", self._calculate_choice_timing(touch))
     self._got_card_touch = True
 
   def right_card_selected(self, image, touch):
-    if self._got_card_touch: return
+    if self._got_card_touch or self._trial_start_time is None: return
     self._enable_cards(False)
     self._image_left_card.opacity = 0
-    self.dispatch("on_right_card_chosen", self._calculate_time_till_choice())
+    self._video_stats = self._video_manager.end_trial()
+    self.dispatch("on_right_card_chosen", self._calculate_choice_timing(touch))
     self._got_card_touch = True
 
-  def on_left_card_chosen(self, time_taken):
+  def get_slot_roles(self):
+    # image slot -> "left_card", "right_card" or "background", for this trial
+    return dict(self._slot_roles)
+
+  def _on_image_place_touched(self, image_place, touch):
+    self._role_handlers[self._slot_roles[image_place]](image_place, touch)
+
+  def on_touch_down(self, touch):
+    # find the touched widget from the precomputed rectangles instead of walking the widget tree
+    if self._touch_geometry is None:
+      self._touch_geometry = [(widget, widget.x, widget.y, widget.right, widget.top) for widget in self._touch_widgets]
+    x, y = self.to_local(*touch.pos)
+    for widget, left, bottom, right, top in self._touch_geometry:
+      if left <= x <= right and bottom <= y <= top:
+        touch.push()
+        touch.apply_transform_2d(self.to_local)
+        try:
+          # dispatched, so handlers bound to the widget's on_touch_down see the touch too
+          return widget.dispatch("on_touch_down", touch)
+        finally:
+          touch.pop()
+    return super(TrialScreen, self).on_touch_down(touch)
+
+  def _invalidate_touch_geometry(self, *args):
+    self._touch_geometry = None
+
+  def set_touch_recorder(self, touch_recorder):
+    self._touch_recorder = touch_recorder
+
+  def set_telemetry(self, telemetry):
+    self._telemetry = telemetry
+
+  def _record_touch(self, slot, widget, touch):
+    if self._touch_recorder is not None:
+      self._touch_recorder.record(timing.touch_event_time(touch)[0], touch.x, touch.y, slot)
+    if self._telemetry is not None:
+      self._telemetry.publish("touch", slot=slot, x=touch.x, y=touch.y)
+
+  def on_left_card_chosen(self, choice_timing):
     pass
 
-  def on_right_card_chosen(self, time_taken):
+  def on_right_card_chosen(self, choice_timing):
     pass
 
-  def _calculate_time_till_choice(self):
-    return (datetime.now() - self._trial_start_time).total_seconds()
+  def _calculate_choice_timing(self, touch):
+    touch_time, touch_delay = timing.touch_event_time(touch)
+    # from switching to the trial screen till the cards were presented
+    onset_delay = self._trial_start_time - self._pre_enter_time
+    return timing.ChoiceTiming(self._trial_start_time, touch_time, touch_time + touch_delay, onset_delay)
 
   def set_condition(self, condition):
     # condition: util.Condition()
-    self.ids.video_condition.source = condition.video
+    # start the video now so its decoder is warm by the time the first trial shows
+    self._video_manager.load(self._get_asset_path(condition.video))
     self._condition = condition
 
   def on_pre_enter(self):
+    self._pre_enter_time = timing.now()
+    # with NoTransition on_enter only comes on the tick after the screen was drawn, so the first flip showing the
+    # cards has to be awaited from here
+    self._awaiting_first_frame = True
+    Clock.unschedule(self._on_first_frame_presented)
+    self._trial_start_time = None
+    self._entered = False
     if self._image_left_card is not None: # at first time the trial screen is shown
       self._enable_cards(True)
       self._show_cards(True)
-    # randomize the placement of cards and bind images without content as background touches
+    # randomize the placement of cards and make images without content background touch detectors
     image_places = self._get_image_places()
     image_index_left, image_index_right = 0, 0
     # ensure chosen placements are not the same
@@ -122,22 +246,41 @@ class TrialScreen(Screen):
     image_places.remove(image_place_right)
     # now what's left in image_places is background touch detectors
     condition_images = self._condition.get_associated_images()
-    image_place_left.bind(on_really_touch_down=self.left_card_selected)
-    image_place_left.source = condition_images["left_image"]
-    image_place_right.bind(on_really_touch_down=self.right_card_selected)
-    image_place_right.source = condition_images["right_image"]
+    self._slot_roles[image_place_left] = "left_card"
+    image_place_left.texture = self._texture_cache.get(condition_images["left_image"])
+    self._slot_roles[image_place_right] = "right_card"
+    image_place_right.texture = self._texture_cache.get(condition_images["right_image"])
+    texture_placeholder = self._texture_cache.get(get_background_placeholder())
     for image_place in image_places:
-      image_place.bind(on_really_touch_down=self.on_background_touched)
-      image_place.source = get_background_placeholder()
+      self._slot_roles[image_place] = "background"
+      image_place.texture = texture_placeholder
     self._image_left_card = image_place_left
     self._image_right_card = image_place_right
 
   def on_enter(self):
     self._got_card_touch = False
-    self.ids.video_condition.state = "play"
-    self._trial_start_time = datetime.now()
+    self._trial_enter_time = timing.now()
+    self._entered = True
+    # the first frame is usually presented after on_enter. the video trial starts with it
+    if self._trial_start_time is not None:
+      self._video_manager.begin_trial(self._trial_start_time)
     self._init_touch_count()
 
+  def _on_window_flip(self, window):
+    # on_flip handlers run before the window swaps its buffers, so the frame is presented once the flip is done.
+    # the next clock tick comes right after it
+    if not self._awaiting_first_frame: return
+    self._awaiting_first_frame = False
+    Clock.schedule_once(self._on_first_frame_presented, 0)
+
+  def _on_first_frame_presented(self, elapsed):
+    self._trial_start_time = timing.now()
+    self.last_frame_ready_latency = self._trial_start_time - self._pre_enter_time
+    Logger.debug("TrialScreen: first frame presented {:.1f} ms after on_pre_enter"
+                 .format(self.last_frame_ready_latency * 1000))
+    if self._entered:
+      self._video_manager.begin_trial(self._trial_start_time)
+
   def on_video_touched(self, *args):
     self._video_touches += 1
 
@@ -147,6 +290,10 @@ class TrialScreen(Screen):
   def get_touches(self):
     return self._background_touches, self._video_touches
 
+  def get_video_stats(self):
+    # video frame stats of the last trial, collected when a card was chosen
+    return self._video_stats
+
   def _get_image_places(self):
     return [self.ids.image_place_1, self.ids.image_place_2, self.ids.image_place_3, self.ids.image_place_4,
             self.ids.image_place_5, self.ids.image_place_6, self.ids.image_place_7]
@@ -171,6 +318,9 @@ class ConditionCompleteScreen(Screen):
   def __init__(self, *args, **kwargs):
     super(ConditionCompleteScreen, self).__init__(*args, **kwargs)
     self.register_event_type("on_key_pressed")
+
+  def on_enter(self):
+    # only take the keyboard once the screen shows, not when it's built
     keyboard = Window.request_keyboard(self._keyboard_closed, self, "text")
     keyboard.bind(on_key_down=self._key_pressed)
 
@@ -186,135 +336,321 @@ class ConditionCompleteScreen(Screen):
   def on_key_pressed(self):
     pass
 
+class LazyScreenManager(ScreenManager):
+  """
+  A screen manager that builds screens from factories the first time they're needed.
+    Screens nobody asked for yet can be built one per frame with `build_next_screen'.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(LazyScreenManager, self).__init__(*args, **kwargs)
+    self._screen_factories = []
+
+  def add_screen_factory(self, name, factory):
+    self._screen_factories.append((name, factory))
+
+  def get_screen(self, name):
+    for index, (factory_name, factory) in enumerate(self._screen_factories):
+      if factory_name == name:
+        del self._screen_factories[index]
+        self._build_screen(name, factory)
+        break
+    return super(LazyScreenManager, self).get_screen(name)
+
+  def has_screen(self, name):
+    return any(factory_name == name for factory_name, _ in self._screen_factories) or \
+           super(LazyScreenManager, self).has_screen(name)
+
+  def build_next_screen(self, *args):
+    # returns False when there's nothing left to build, which also stops a Clock interval
+    if not self._screen_factories:
+      return False
+    self._build_screen(*self._screen_factories.pop(0))
+    return bool(self._screen_factories)
+
+  def _build_screen(self, name, factory):
+    start_time = timing.now()
+    self.add_widget(factory(name))
+    build_time = timing.now() - start_time
+    # built after the first frame, between other frames. timed alone so the frames in between don't count
+    startup_profile.add("screen " + name, build_time)
+    Logger.debug("LazyScreenManager: built '{}' in {:.1f} ms".format(name, build_time * 1000))
+
+def _get_memory_profile_trial_block():
+  # PRIMATE_MEMORY_PROFILE=<trials per block>. anything but a whole number of trials leaves profiling off
+  value = os.environ.get("PRIMATE_MEMORY_PROFILE", "").strip()
+  if not value:
+    return 0
+  try:
+    trial_block = int(value)
+  except ValueError:
+    trial_block = -1
+  if trial_block < 0:
+    Logger.warning("PriMate: PRIMATE_MEMORY_PROFILE={!r} isn't a number of trials, memory profiling is off".format(value))
+    return 0
+  return trial_block
+
 class PriMateApp(App):
 
   _total_trial_count = 200
-  _inter_pellet_wait_seconds = 0.4
-
-  def __init__(self, *args, **kwargs):
+  # stats file flush policy. rows are written off the main thread either way
+  _stats_flush_every_rows = 1
+  _stats_flush_interval_ms = None
+  _stats_fsync = True
+  # opt-in memory profiling: PRIMATE_MEMORY_PROFILE=<trials per block> checkpoints every block and condition end
+  _memory_profile_trial_block = _get_memory_profile_trial_block()
+  # live trial events for `python -m lib.telemetry': PRIMATE_TELEMETRY=tcp:127.0.0.1:7700 or unix:<path>
+  _telemetry_address = os.environ.get("PRIMATE_TELEMETRY")
+
+  def __init__(self, subject_manager=None, dispenser_port=None, subject=None, booth_name="primate", *args, **kwargs):
+    # a booth run by lib.booths passes a shared subject manager, its own dispenser port and optionally a fixed subject
     super(PriMateApp, self).__init__(*args, **kwargs)
-    self._count_left_card_chosen = 0
-    self._count_right_card_chosen = 0
-    self._index_current_trial = None
-    self._csv_reader_non_risky = csv.reader(open(join(dirname(__file__), "config", "EPGT_Payoff.csv"), 'r'))
-    self._csv_reader_risky = csv.reader(open(join(dirname(__file__), "config", "EPGT_Payoff_Risky.csv"), 'r'))
-    self._subject_manager = SubjectManager(self._total_trial_count)
-    self._current_subject = None
-    self._current_condition = None
-    self._current_trial_data = None
+    self._booth_name = booth_name
+    # frame times, callback durations and screen transitions, exported to config/metrics_<booth>.prom
+    self._metrics = MetricsRegistry()
+    self._subject_manager = subject_manager or SubjectManager(self._total_trial_count)
+    self._dispenser = PelletDispenser(dispenser_port) if dispenser_port else PelletDispenser()
+    self._booth_subject = subject
+    self._session_start_time = None
+    # booth turnaround: from selecting a subject till its first start trial screen is presented
+    self._subject_selected_time = None
+    self.last_turnaround = None
+    self._touch_recorder = None
+    self._memory_profiler = None
+    self._texture_cache = None
+    self._telemetry = TelemetryPublisher(self._telemetry_address, booth_name) if self._telemetry_address else None
+    self._trial_writer = TrialDataWriter(self._stats_flush_every_rows, self._stats_flush_interval_ms, self._stats_fsync)
+    self._session = TrialSession(self._subject_manager, PayoffSchedules(), self._dispenser, self._trial_writer,
+                                 InstrumentedClock(Clock, self._metrics), self, join(dirname(__file__), "config"),
+                                 self._total_trial_count, on_timeline_event=self._publish_timeline_event)
+    startup_profile.mark("subjects and config")
+
+  def on_start(self):
+    # open the dispenser port once for the whole session. if it can't be opened, every pellet tries again
+    self._dispenser.open()
+    if self._booth_subject is not None:
+      self.start_subject(self._booth_subject)
 
   def build(self):
     Builder.load_file("ui/screens.kv")
-    manager_screen = ScreenManager(transition=NoTransition())
+    startup_profile.mark("kv rules")
+    # only the subject screen is needed right away. the others are built on the frames after it shows
+    manager_screen = LazyScreenManager(transition=NoTransition())
     screen_subject = SubjectScreen(self._subject_manager, name="subject")
     screen_subject.bind(on_subject_selected=self.start_trial_screen)
     manager_screen.add_widget(screen_subject)
-    manager_screen.add_widget(StartTrialScreen(name="start_trial"))
-    screen_trial = TrialScreen(name="trial")
-    screen_trial.bind(on_left_card_chosen=self.on_left_card_chosen)
-    screen_trial.bind(on_right_card_chosen=self.on_right_card_chosen)
-    manager_screen.add_widget(screen_trial)
-    manager_screen.add_widget(BlankScreen(name="blank_screen"))
-    screen_condition_complete = ConditionCompleteScreen(name="condition_complete")
-    screen_condition_complete.bind(on_key_pressed=self.stop)
-    manager_screen.add_widget(screen_condition_complete)
+    startup_profile.mark("subject screen")
+    manager_screen.add_screen_factory("start_trial", lambda name: StartTrialScreen(name=name))
+    manager_screen.add_screen_factory("trial", self._build_trial_screen)
+    manager_screen.add_screen_factory("blank_screen", lambda name: BlankScreen(name=name))
+    manager_screen.add_screen_factory("condition_complete", self._build_condition_complete_screen)
+    Window.bind(on_flip=self._on_first_frame)
+    self._assets = AssetCache(*Window.size)
+    if self._assets.is_prepared(get_asset_paths()):
+      Logger.info("PriMate: assets prepared for {}x{}".format(*Window.size))
+    else:
+      self._start_asset_preparation()
+    self._ui_instrumentation = UiInstrumentation(self._metrics, manager_screen, self._get_metrics_file_name(".prom"))
     return manager_screen
 
+  def _build_trial_screen(self, name):
+    # decode every card image once, before any trial needs it. prepared images are used where they're ready
+    self._texture_cache = TextureCache(self._assets.get)
+    self._texture_cache.preload(get_trial_image_paths())
+    screen_trial = TrialScreen(self._texture_cache, self._assets.get, name=name)
+    screen_trial.set_telemetry(self._telemetry)
+    screen_trial.bind(on_left_card_chosen=self._metrics.timed("callback_seconds", self.on_left_card_chosen,
+                                                              callback="left_card_chosen"))
+    screen_trial.bind(on_right_card_chosen=self._metrics.timed("callback_seconds", self.on_right_card_chosen,
+                                                               callback="right_card_chosen"))
+    return screen_trial
+
+  def _build_condition_complete_screen(self, name):
+    screen_condition_complete = ConditionCompleteScreen(name=name)
+    screen_condition_complete.bind(on_key_pressed=self.stop)
+    return screen_condition_complete
+
+  def _start_asset_preparation(self):
+    # assets are normally prepared before the session, by `python -m lib.assets' or lib.booths. what's missing is
+    # transcoded in its own process, so neither the kivy loop nor kivy's window is involved, and the screens use the
+    # originals till then. it's one single threaded transcode at the lowest priority, to leave the cores to the trials
+    Logger.warning("PriMate: assets aren't prepared for {}x{}, transcoding in the background"
+                   .format(self._assets.width, self._assets.height))
+    command = [sys.executable, "-m", "lib.assets", "--width", str(self._assets.width),
+               "--height", str(self._assets.height), "--background"]
+
+    def prepare():
+      result = subprocess.run(command, cwd=dirname(abspath(__file__)), stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, creationflags=getattr(subprocess, "IDLE_PRIORITY_CLASS", 0))
+      Clock.schedule_once(partial(self._on_assets_prepared, result.returncode, result.stdout.decode(errors="replace")))
+
+    preparation_thread = threading.Thread(target=prepare, name="asset-preparation")
+    preparation_thread.daemon = True
+    preparation_thread.start()
+
+  def _on_assets_prepared(self, return_code, output, elapsed):
+    Logger.info("PriMate: asset preparation exited with code {}:\n{}".format(return_code, output.strip()))
+    # videos loaded from now on come from the cache. images already decoded are decoded again from their prepared
+    # files, now rather than when a trial first shows them
+    self._assets.reload()
+    if self._texture_cache is not None:
+      self._texture_cache.preload(get_trial_image_paths())
+
+  def _on_first_frame(self, window):
+    Window.unbind(on_flip=self._on_first_frame)
+    startup_profile.mark("first frame")
+    Logger.info("PriMate: startup profile\n" + startup_profile.report())
+    Clock.schedule_interval(self._build_next_screen, 0)
+
+  def _build_next_screen(self, elapsed):
+    if self.root.build_next_screen():
+      return True
+    # every screen is built. the profile again, with the screens built after the first frame
+    Logger.info("PriMate: startup profile with every screen\n" + startup_profile.report())
+    return False
+
   def start_trial_screen(self, screen_subject, button_subject):
+    self.start_subject(button_subject.subject)
+
+  def start_subject(self, subject):
     # now we have a subject selected, we can get it's next condition and inform other screens
-    self._current_subject = button_subject.text
-    # write a csv with header for the new subject. only created if the subject ran no trials before
-    if len(self._subject_manager.get_conditions(self._current_subject)) == 0:
-      with open(self._get_stats_file_name(), 'w') as stats_file:
-        csv_writer = csv.writer(stats_file)
-        csv_writer.writerow(["Trial Index", "Date", "Time", "Subject", "Condition", "Card Selected",
-                             "Pellets Dispensed", "Background Touches",
-                             "Video Touches", "Time till Choice (sec)"])
-    condition_subject = self._subject_manager.get_unfinished_condition(self._current_subject)
-    self._index_current_trial = condition_subject.next_trial_index
-    self._skip_payoff_lines()
-    self._current_condition = condition_subject
+    self._subject_selected_time = timing.now()
+    try:
+      condition_subject = self._session.start(subject)
+    except SubjectClaimedError as e:
+      # another booth started the subject since this booth's list was read. show it as running there
+      Logger.warning("PriMate: {}".format(e))
+      self._subject_selected_time = None
+      self.root.get_screen("subject").refresh()
+      return
+    self._session_start_time = timing.now()
     self.root.get_screen("trial").set_condition(condition_subject)
-    self.root.get_screen("condition_complete").set_subject_and_condition(self._current_subject, condition_subject.name)
-    self._restart_trial(0)
-
-  def on_left_card_chosen(self, screen, time_till_choice):
+    # one touch stream file per session
+    if self._touch_recorder is None:
+      self._touch_recorder = TouchRecorder(self._get_touches_file_name())
+      self.root.get_screen("trial").set_touch_recorder(self._touch_recorder)
+    self.root.get_screen("condition_complete").set_subject_and_condition(self._session.subject, condition_subject.name)
+    self._session.begin()
+    if self._memory_profile_trial_block:
+      # the baseline is taken once every screen is built and the condition is loaded
+      self._memory_profiler = MemoryProfiler(self._get_metrics_file_name(
+          datetime.now().strftime("_memory_%Y%m%d-%H%M%S.txt")))
+      self._memory_profiler.start("{} {} start".format(subject, condition_subject.name))
+
+  def start_trial_pressed(self):
+    # called from kv. the session shows the trial screen
+    self._session.show_trial()
+
+  def on_left_card_chosen(self, screen, choice_timing):
     # called from kv when left card chosen
-    count_pellets = int(next(self._csv_reader_risky)[0])
-    self._update_trial_data(time_till_choice, "Risky", count_pellets)
-    self._dispense_pellets(count_pellets)
-    self._count_left_card_chosen += 1
-    self._wait_till_five_seconds(count_pellets)
-
-  def on_right_card_chosen(self, screen, time_till_choice):
-    # also called from kv. this is the risky card
-    count_pellets = int(next(self._csv_reader_non_risky)[0])
-    self._update_trial_data(time_till_choice, "Safe", count_pellets)
-    self._dispense_pellets(count_pellets)
-    self._count_right_card_chosen += 1
-    self._wait_till_five_seconds(count_pellets)
-
-  def _wait_till_five_seconds(self, count_pellets):
-    # complete the time taken to dispense pellets up for 5 seconds
-    Clock.schedule_once(self._go_to_blank, 6 - self._inter_pellet_wait_seconds * count_pellets)
-
-  def _go_to_blank(self, elapsed):
-    self.root.current = "blank_screen"
-    # keep the blank for 10 seconds
-    Clock.schedule_once(self._restart_trial, 10)
-    self._subject_manager.passed_trial(self._current_subject, self._current_condition)
-
-  def _dispense_pellets(self, count, tick_time=0):
-    if count == 0: return
-    dispense_pellet()
-    Clock.schedule_once(partial(self._dispense_pellets, count - 1), self._inter_pellet_wait_seconds)
-
-  def _restart_trial(self, elapsed):
-    if self._index_current_trial == self._total_trial_count:
-      self._index_current_trial = 0
-      self._subject_manager.save()
-      self.root.current = "condition_complete"
-    else:
-      self._current_trial_data = TrialData(self._current_subject, self._index_current_trial, self._current_condition.name)
-      self.root.current = "start_trial"
-    self._index_current_trial += 1
-
-  def _update_trial_data(self, time_till_choice, card_name, pellets_dispensed):
-    self._current_trial_data.time_till_selection = time_till_choice
-    self._current_trial_data.card_selected = card_name
-    self._current_trial_data.pellets_dispensed = pellets_dispensed
+    self._session.left_card_chosen(choice_timing)
+    self._publish_choice()
+
+  def on_right_card_chosen(self, screen, choice_timing):
+    # also called from kv
+    self._session.right_card_chosen(choice_timing)
+    self._publish_choice()
+
+  def _publish_choice(self):
+    if self._telemetry is None: return
+    trial = self._session.trial_data
+    self._telemetry.publish("choice", subject=trial.subject, condition=trial.condition, trial=trial.trial_index + 1,
+                            card=trial.card_selected, pellets=trial.pellets_dispensed,
+                            time_till_choice=trial.time_till_selection, touch_delay_ms=trial.touch_delay,
+                            background_touches=trial.background_touches, video_touches=trial.video_touches,
+                            video_late_frames=trial.video_late_frames, video_dropped_frames=trial.video_dropped_frames)
+
+  def _publish_timeline_event(self, event):
+    # dispenses, blank and next trial, with how late they ran
+    if self._telemetry is not None:
+      self._telemetry.publish(event.name, trial=event.trial_index + 1, planned=event.planned,
+                              error_ms=event.error * 1000)
+
+  def show_screen(self, name):
+    # called by the trial session
+    if self._telemetry is not None:
+      trial = self._session.trial_data.trial_index + 1 if self._session.trial_data else None
+      if name == "trial":
+        self._telemetry.publish("trial_start", subject=self._session.subject, condition=self._session.condition.name,
+                                trial=trial)
+      else:
+        self._telemetry.publish("screen", screen=name, subject=self._session.subject, trial=trial)
+    if name == "start_trial":
+      if self._subject_selected_time is not None:
+        Window.bind(on_flip=self._on_first_start_trial_frame)
+      trial_index = self._session.trial_data.trial_index
+      self._touch_recorder.trial_index = trial_index
+      if self._memory_profiler is not None and trial_index % self._memory_profile_trial_block == 0:
+        self._memory_profiler.checkpoint("trial {}".format(trial_index + 1))
+    elif name == "condition_complete":
+      self.root.get_screen("subject").refresh()
+      if self._memory_profiler is not None:
+        self._memory_profiler.checkpoint("{} complete".format(self._session.condition.name))
+    self.root.current = name
+
+  def collect_trial_data(self, trial_data):
+    # called by the trial session once a card is chosen
     screen_trial = self.root.get_screen("trial")
-    background_touches, video_touches = screen_trial.get_touches()
-    self._current_trial_data.background_touches = background_touches
-    self._current_trial_data.video_touches = video_touches
-    self._write_trial_data()
-
-  def _write_trial_data(self):
-    with open(self._get_stats_file_name(), 'a') as stats_file:
-      csv_writer = csv.writer(stats_file)
-      trial = self._current_trial_data
-      csv_writer.writerow([trial.trial_index + 1, trial.date, trial.time, trial.subject, trial.condition, trial.card_selected,
-                           trial.pellets_dispensed, trial.background_touches, trial.video_touches, trial.time_till_selection])
-
-  def _get_stats_file_name(self):
-    # stats file name should include the name of the current subject
-    return join(dirname(__file__), "config", "stats_{}.csv"
-        .format(variablize_string(self._current_subject)))
-
-  def _skip_payoff_lines(self):
-    # match the current payoff with the current index
-    for _ in range(self._index_current_trial):
-      next(self._csv_reader_risky)
-      next(self._csv_reader_non_risky)
+    trial_data.background_touches, trial_data.video_touches = screen_trial.get_touches()
+    video_stats = screen_trial.get_video_stats()
+    if video_stats.first_frame_latency is not None:
+      trial_data.video_first_frame_latency = video_stats.first_frame_latency * 1000
+    trial_data.video_late_frames = video_stats.late_frames
+    trial_data.video_dropped_frames = video_stats.dropped_frames
+
+  def _on_first_start_trial_frame(self, window):
+    # the frame is presented after the on_flip handlers, so it's timed on the next tick
+    Window.unbind(on_flip=self._on_first_start_trial_frame)
+    Clock.schedule_once(self._on_first_start_trial_presented, 0)
+
+  def _on_first_start_trial_presented(self, elapsed):
+    self.last_turnaround = timing.now() - self._subject_selected_time
+    self._subject_selected_time = None
+    self._metrics.histogram("turnaround_seconds", "subject selected till its first start trial screen was presented")\
+      .observe(self.last_turnaround)
+    Logger.info("PriMate: {} ready for its first trial {:.1f} ms after it was selected"
+                .format(self._session.subject, self.last_turnaround * 1000))
+
+  def get_session_metrics(self):
+    # a snapshot of the session for booth health reports
+    session = self._session
+    trial_count = session.count_left_card_chosen + session.count_right_card_chosen
+    metrics = {"subject": session.subject, "condition": session.condition.name if session.condition else None,
+               "trial_index": session.trial_data.trial_index if session.trial_data else None,
+               "trials": trial_count, "left_chosen": session.count_left_card_chosen,
+               "right_chosen": session.count_right_card_chosen, "dispenser": self._dispenser.stats.summary(),
+               "timeline": session.get_timeline_jitter(), "turnaround": self.last_turnaround}
+    if self._session_start_time is not None:
+      metrics["trials_per_hour"] = trial_count * 3600. / max(1, timing.now() - self._session_start_time)
+    return metrics
+
+  def _get_metrics_file_name(self, extension):
+    return join(dirname(__file__), "config", "metrics_{}{}".format(variablize_string(self._booth_name), extension))
+
+  def _get_touches_file_name(self):
+    return join(dirname(__file__), "config", "touches_{}_{}.bin"
+        .format(variablize_string(self._session.subject), datetime.now().strftime("%Y%m%d-%H%M%S")))
 
   def on_stop(self):
     self._subject_manager.save()
+    if self._touch_recorder is not None:
+      self._touch_recorder.close()
+    self._dispenser.close()
+    self._trial_writer.close()
+    Logger.info("PriMate: dispenser stats {}".format(self._dispenser.stats.summary()))
+    Logger.info("PriMate: trial timeline jitter {}".format(self._session.get_timeline_jitter()))
+    self._ui_instrumentation.export()
+    if self._memory_profiler is not None:
+      self._memory_profiler.stop()
+    if self._telemetry is not None:
+      self._telemetry.publish("stopped")
+      self._telemetry.close()
+      Logger.info("PriMate: telemetry {}".format(self._telemetry.get_stats()))
+    self._metrics.write_summary(self._get_metrics_file_name(datetime.now().strftime("_%Y%m%d-%H%M%S.json")),
+                                session=self.get_session_metrics())
 
 
 if __name__ == "__main__":
-  from kivy.core.window import Window
-  import tkinter
-  root = tkinter.Tk()
-  Window.size = (root.winfo_screenwidth(), root.winfo_screenheight())
-  Window.fullscreen = True
+  # "auto" goes fullscreen at the desktop resolution, no need to ask tkinter for the screen size
+  Window.fullscreen = "auto"
   PriMateApp().run()
\ No newline at end of file
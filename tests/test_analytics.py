@@ -0,0 +1,107 @@
+__author__ = 'Mohammed Hamdy'
+
+import csv, os, shutil, tempfile, unittest
+from os.path import join, exists
+
+try:
+  import numpy
+  from lib.analytics import StatsFileCache, load_stats
+except ImportError:
+  numpy = None
+
+header = ["Trial Index", "Date", "Time", "Subject", "Condition", "Card Selected", "Pellets Dispensed",
+          "Time till Choice (sec)"]
+
+def make_row(index, card="Risky"):
+  return [index, "10-17-26", "14:05:{:02d} PM".format(index % 60), "subject1", "high_ranking", card, index % 3, index * 0.5]
+
+@unittest.skipIf(numpy is None, "analytics needs numpy")
+class StatsFileCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    self.stats_path = join(self.directory, "stats_subject1.csv")
+    self.cache_dir = join(self.directory, ".analytics_cache")
+    self.parsed_rows = []
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def write(self, rows, mode='a', file_header=header):
+    with open(self.stats_path, mode, newline='') as stats_writer:
+      if mode == 'w':
+        csv.writer(stats_writer).writerow(file_header)
+      csv.writer(stats_writer).writerows(rows)
+
+  def load(self):
+    # records how many rows every load parsed
+    cache = StatsFileCache(self.stats_path, self.cache_dir)
+    parse_rows = cache._parse_rows
+    def counting_parse_rows(file_header, text):
+      columns = parse_rows(file_header, text)
+      self.parsed_rows.append(len(columns["risky"]))
+      return columns
+    cache._parse_rows = counting_parse_rows
+    return cache.load()
+
+  def test_unchanged_file_is_read_from_the_cache(self):
+    self.write([make_row(index) for index in range(1, 6)], 'w')
+    self.load()
+    columns = self.load()
+    self.assertEqual(self.parsed_rows, [5])
+    self.assertEqual(columns["trial_index"].tolist(), [1, 2, 3, 4, 5])
+    self.assertTrue(exists(join(self.cache_dir, "stats_subject1.npz")))
+
+  def test_only_appended_rows_are_parsed(self):
+    self.write([make_row(index) for index in range(1, 6)], 'w')
+    self.load()
+    self.write([make_row(6, "Safe"), make_row(7)])
+    columns = self.load()
+    self.assertEqual(self.parsed_rows, [5, 2])
+    self.assertEqual(columns["trial_index"].tolist(), [1, 2, 3, 4, 5, 6, 7])
+    self.assertEqual(columns["risky"].tolist(), [True] * 5 + [False, True])
+    self.assertEqual(columns["choice_time"].tolist(), [index * 0.5 for index in range(1, 8)])
+
+  def test_row_without_line_end_waits_for_the_next_load(self):
+    self.write([make_row(1)], 'w')
+    with open(self.stats_path, 'a', newline='') as stats_writer:
+      stats_writer.write("2,10-17-26,14:05:02 PM,subj")
+    self.assertEqual(self.load()["trial_index"].tolist(), [1])
+    with open(self.stats_path, 'a', newline='') as stats_writer:
+      stats_writer.write("ect1,high_ranking,Safe,0,1.0\r\n")
+    columns = self.load()
+    self.assertEqual(self.parsed_rows, [1, 1])
+    self.assertEqual(columns["trial_index"].tolist(), [1, 2])
+
+  def test_rewritten_file_is_parsed_again(self):
+    self.write([make_row(index) for index in range(1, 6)], 'w')
+    self.load()
+    # same size, later mtime: the file was replaced, not appended to
+    self.write([make_row(index + 4) for index in range(1, 6)], 'w')
+    stat = os.stat(self.stats_path)
+    os.utime(self.stats_path, (stat.st_atime, stat.st_mtime + 10))
+    self.assertEqual(self.load()["trial_index"].tolist(), [5, 6, 7, 8, 9])
+    # a shorter file can't hold the cached rows either
+    self.write([make_row(1)], 'w')
+    self.assertEqual(self.load()["trial_index"].tolist(), [1])
+    self.assertEqual(self.parsed_rows, [5, 5, 1])
+
+  def test_upgraded_header_is_parsed_again(self):
+    self.write([row[:6] for row in map(make_row, range(1, 4))], 'w', header[:6])
+    self.assertTrue(numpy.isnan(self.load()["pellets"]).all())
+    self.write([make_row(index) for index in range(1, 5)], 'w')
+    columns = self.load()
+    self.assertEqual(self.parsed_rows, [3, 4])
+    self.assertEqual(columns["pellets"].tolist(), [1, 2, 0, 1])
+
+  def test_load_stats_joins_the_subjects(self):
+    self.write([make_row(index) for index in range(1, 4)], 'w')
+    with open(join(self.directory, "stats_subject2.csv"), 'w', newline='') as stats_writer:
+      csv.writer(stats_writer).writerows([header, make_row(1, "Safe")])
+    table = load_stats(self.directory)
+    self.assertEqual(table.subject_names, ["subject1", "subject2"])
+    self.assertEqual(table["subject"].tolist(), [0, 0, 0, 1])
+    self.assertEqual(table["risky"].tolist(), [True, True, True, False])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,63 @@
+__author__ = 'Mohammed Hamdy'
+
+import json, os, shutil, stat, sys, tempfile, unittest
+from os.path import join
+from lib.assets import AssetCache
+
+# stands in for ffmpeg: copies the input (after -i) to the target (the last argument)
+_fake_ffmpeg = """#!{}
+import shutil, sys
+shutil.copyfile(sys.argv[sys.argv.index("-i") + 1], sys.argv[-1])
+"""
+
+@unittest.skipUnless(os.name == "posix", "the fake ffmpeg is a script run through its shebang")
+class AssetCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    self.cache_dir = join(self.directory, "cache")
+    self.ffmpeg = join(self.directory, "ffmpeg")
+    with open(self.ffmpeg, 'w') as ffmpeg_writer:
+      ffmpeg_writer.write(_fake_ffmpeg.format(sys.executable))
+    os.chmod(self.ffmpeg, stat.S_IRWXU)
+    self.paths = []
+    for name in ("stranger.mp4", "moon.png"):
+      self.paths.append(join(self.directory, name))
+      with open(self.paths[-1], 'wb') as asset_writer:
+        asset_writer.write(name.encode())
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def make_cache(self, width, height):
+    return AssetCache(width, height, self.cache_dir, self.ffmpeg, max_workers=1, ffmpeg_threads=1)
+
+  def test_resolutions_share_the_manifest(self):
+    cache_full_hd, cache_small = self.make_cache(1920, 1080), self.make_cache(1280, 720)
+    # both read the empty manifest before either saved
+    self.assertEqual(cache_full_hd.prepare(self.paths).transcoded, 2)
+    self.assertEqual(cache_small.prepare(self.paths).transcoded, 2)
+    for width, height in ((1920, 1080), (1280, 720)):
+      cache = self.make_cache(width, height)
+      for path in self.paths:
+        self.assertNotEqual(cache.get(path), path)
+        self.assertIn("{}x{}".format(width, height), cache.get(path))
+    with open(join(self.cache_dir, "manifest.json")) as manifest_reader:
+      self.assertEqual(sorted(json.load(manifest_reader)[self.paths[0]]), ["1280x720", "1920x1080"])
+
+  def test_unprepared_and_changed_assets_fall_back_to_the_original(self):
+    cache = self.make_cache(1920, 1080)
+    self.assertEqual(cache.get(self.paths[0]), self.paths[0])
+    self.assertFalse(cache.is_prepared(self.paths))
+    cache.prepare(self.paths)
+    self.assertTrue(self.make_cache(1920, 1080).is_prepared(self.paths))
+    self.assertFalse(self.make_cache(1280, 720).is_prepared(self.paths))
+    self.assertEqual(self.make_cache(1920, 1080).prepare(self.paths).cached, 2)
+    with open(self.paths[0], 'ab') as asset_writer:
+      asset_writer.write(b" changed")
+    self.assertFalse(self.make_cache(1920, 1080).is_prepared(self.paths))
+    report = self.make_cache(1920, 1080).prepare(self.paths)
+    self.assertEqual((report.cached, report.transcoded), (1, 1))
+
+if __name__ == "__main__":
+  unittest.main()
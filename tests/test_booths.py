@@ -0,0 +1,60 @@
+__author__ = 'Mohammed Hamdy'
+
+import shutil, tempfile, unittest
+from lib.booths import SubjectCoordinator, CoordinatedSubjectManager, SubjectClaimedError
+from lib.payoff import PayoffSchedules
+from lib.session import TrialSession
+from lib.simulation import VirtualClock, FakeDispenser, MemoryTrialWriter, make_colony
+from lib.util import SubjectManager
+
+class NoScreens(object):
+
+  def show_screen(self, name):
+    pass
+
+  def collect_trial_data(self, trial_data):
+    pass
+
+class SubjectClaimTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    subjects_file_path, video_dir = make_colony(self.directory, 2)
+    self.coordinator = SubjectCoordinator(SubjectManager(200, subjects_file_path, video_dir))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def make_session(self, booth):
+    trial_writer = MemoryTrialWriter()
+    session = TrialSession(CoordinatedSubjectManager(self.coordinator, booth), PayoffSchedules(), FakeDispenser(),
+                           trial_writer, VirtualClock(), NoScreens(), self.directory)
+    return session, trial_writer
+
+  def test_subject_running_elsewhere_is_refused_before_any_side_effect(self):
+    session1, _ = self.make_session("booth1")
+    session2, trial_writer2 = self.make_session("booth2")
+    # both booths listed subject1 as available before either started it
+    self.assertTrue(all(status.available for status in CoordinatedSubjectManager(self.coordinator, "booth2")
+                        .get_subject_statuses()))
+    session1.start("subject1")
+    with self.assertRaises(SubjectClaimedError):
+      session2.start("subject1")
+    self.assertIsNone(session2.subject)
+    self.assertIsNone(session2.condition)
+    self.assertEqual(trial_writer2.rows, {})
+    statuses = dict((status.subject, status) for status in self.coordinator.get_subject_statuses("booth2"))
+    self.assertEqual(statuses["subject1"].running_in, "booth1")
+    self.assertFalse(statuses["subject1"].available)
+    # the booth can go on with another subject
+    self.assertEqual(session2.start("subject2").condition_name, "high_ranking")
+
+  def test_released_subject_can_be_started_by_another_booth(self):
+    session1, _ = self.make_session("booth1")
+    session2, _ = self.make_session("booth2")
+    session1.start("subject1")
+    self.coordinator.release_booth("booth1")
+    self.assertEqual(session2.start("subject1").condition_name, "high_ranking")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,129 @@
+__author__ = 'Mohammed Hamdy'
+
+import shutil, tempfile, unittest
+from lib.dispenser import PelletDispenser
+from lib.payoff import PayoffSchedules
+from lib.session import TrialSession, stats_header
+from lib.simulation import VirtualClock, MemoryTrialWriter, FakeDispenser, make_colony
+from lib.timing import ChoiceTiming
+from lib.util import SubjectManager
+
+try:
+  import serial
+  from lib.fake_dispenser import FakeDispenserDevice
+except ImportError: # no pyserial, or no pty module (windows)
+  serial = None
+
+@unittest.skipIf(serial is None, "needs pyserial and a posix pty")
+class PelletDispenserTest(unittest.TestCase):
+
+  def setUp(self):
+    self.devices = [FakeDispenserDevice().start()]
+    self.results = []
+
+  def tearDown(self):
+    for device in self.devices:
+      device.stop()
+
+  def open_latest_device(self, port, baudrate):
+    # a replugged adapter comes back under the same name. here it's a new pty, so the name is looked up
+    return serial.Serial(self.devices[-1].port, baudrate=baudrate, write_timeout=1)
+
+  def test_writes_one_command_per_pellet(self):
+    device = self.devices[0]
+    dispenser = PelletDispenser(port=device.port)
+    self.assertTrue(dispenser.open())
+    dispenser.dispense(3, self.results.append)
+    dispenser.close()
+    self.assertTrue(device.wait_for_pellets(3))
+    self.assertEqual(device.received, b"p1\r\n" * 3)
+    self.assertEqual(self.results, [True] * 3)
+    stats = dispenser.stats.summary()
+    self.assertEqual((stats["sent"], stats["failed"]), (3, 0))
+
+  def test_pellets_are_lost_when_the_port_cannot_open(self):
+    dispenser = PelletDispenser(port="/dev/primate-no-such-port")
+    self.assertFalse(dispenser.open())
+    dispenser.dispense(2, self.results.append)
+    dispenser.close()
+    self.assertEqual(self.results, [False, False])
+    stats = dispenser.stats.summary()
+    self.assertEqual((stats["sent"], stats["failed"]), (0, 2))
+
+  def test_pellets_before_open_are_lost(self):
+    dispenser = PelletDispenser(port=self.devices[0].port)
+    dispenser.dispense(1, self.results.append)
+    self.assertEqual(self.results, [False])
+    self.assertEqual(dispenser.stats.summary()["failed"], 1)
+
+  def test_port_is_reopened_after_the_device_comes_back(self):
+    dispenser = PelletDispenser(port="replugged", serial_factory=self.open_latest_device)
+    self.assertTrue(dispenser.open())
+    dispenser.dispense(1, self.results.append)
+    self.assertTrue(self.devices[0].wait_for_pellets(1))
+    # unplugged: the open port starts failing writes
+    self.devices[0].stop()
+    self.devices.append(FakeDispenserDevice().start())
+    dispenser.dispense(2, self.results.append)
+    dispenser.close()
+    self.assertTrue(self.devices[1].wait_for_pellets(2))
+    self.assertEqual(self.results, [True] * 3)
+    stats = dispenser.stats.summary()
+    self.assertEqual((stats["sent"], stats["failed"], stats["reopened"]), (3, 0, 1))
+
+class ChoosingScreens(object):
+  # picks the left card in every trial, a second after it shows
+
+  def __init__(self, clock):
+    self._clock = clock
+    self.session = None
+
+  def show_screen(self, name):
+    if name == "start_trial":
+      self._clock.schedule_once(lambda elapsed: self.session.show_trial())
+    elif name == "trial":
+      self._clock.schedule_once(lambda elapsed: self.session.left_card_chosen(ChoiceTiming(0, 1, 1, 0)), 1)
+
+  def collect_trial_data(self, trial_data):
+    pass
+
+class PelletsDeliveredTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def run_condition(self, dispenser):
+    # returns the stats rows of a 5 trial condition
+    subjects_file_path, video_dir = make_colony(self.directory, 1)
+    clock, trial_writer = VirtualClock(), MemoryTrialWriter()
+    screens = ChoosingScreens(clock)
+    screens.session = session = TrialSession(SubjectManager(5, subjects_file_path, video_dir), PayoffSchedules(),
+                                             dispenser, trial_writer, clock, screens, self.directory, 5,
+                                             lambda: clock.time)
+    session.start("subject1")
+    session.begin()
+    clock.run()
+    dispenser.close()
+    rows = trial_writer.rows[session.get_stats_file_name()]
+    self.assertEqual(rows[0], stats_header)
+    return [dict(zip(stats_header, row)) for row in rows[1:]]
+
+  def test_rows_record_the_pellets_the_dispenser_delivered(self):
+    rows = self.run_condition(FakeDispenser())
+    self.assertEqual(len(rows), 5)
+    self.assertTrue(all(row["Pellets Delivered"] == row["Pellets Dispensed"] for row in rows))
+
+  def test_rows_record_pellets_lost_to_a_missing_port(self):
+    dispenser = PelletDispenser(port="/dev/primate-no-such-port")
+    dispenser.open()
+    rows = self.run_condition(dispenser)
+    self.assertEqual(len(rows), 5)
+    self.assertTrue(any(row["Pellets Dispensed"] > 0 for row in rows))
+    self.assertTrue(all(row["Pellets Delivered"] == 0 for row in rows))
+    self.assertEqual(dispenser.stats.summary()["failed"], sum(row["Pellets Dispensed"] for row in rows))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+__author__ = 'Mohammed Hamdy'
+
+import json, os, shutil, tempfile, unittest
+from os.path import join, getsize
+from lib.journal import ProgressJournal
+from lib.simulation import make_colony
+from lib.util import SubjectManager
+
+class JournalTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    self.subjects_file_path, self.video_dir = make_colony(self.directory, 2)
+    self.journal_path = join(self.directory, "subjects.journal")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def make_manager(self, total_trial_count=5):
+    return SubjectManager(total_trial_count, self.subjects_file_path, self.video_dir)
+
+  def read_condition(self, subject, condition_name):
+    with open(self.subjects_file_path, 'r', newline='') as subjects_reader:
+      subject_info = [info for info in json.load(subjects_reader) if info["name"] == subject][0]
+    return [condition for condition in subject_info.get("conditions", []) if condition["name"] == condition_name][0]
+
+class ReplayTest(JournalTestCase):
+
+  def test_progress_of_a_crashed_session_is_replayed(self):
+    subject_manager = self.make_manager()
+    condition = subject_manager.get_unfinished_condition("subject1")
+    for _ in range(3):
+      subject_manager.passed_trial("subject1", condition)
+    # crashed: nothing saved to subjects.json
+    with open(self.subjects_file_path, 'r', newline='') as subjects_reader:
+      self.assertNotIn("conditions", json.load(subjects_reader)[0])
+    subject_manager = self.make_manager()
+    self.assertEqual(subject_manager.get_unfinished_condition("subject1").next_trial_index, 3)
+    # the replayed progress is compacted right away
+    self.assertEqual(self.read_condition("subject1", "high_ranking")["next_trial_index"], 3)
+    self.assertEqual(subject_manager.get_subject_status("subject1").trials_remaining, 4 * 5 - 3)
+
+  def test_half_written_last_record_is_ignored(self):
+    subject_manager = self.make_manager()
+    condition = subject_manager.get_unfinished_condition("subject1")
+    subject_manager.passed_trial("subject1", condition)
+    with open(self.journal_path, 'a', newline='') as journal_writer:
+      journal_writer.write('{"s":"subject1","c":"high_ranking","u":{"next_trial_ind')
+    self.assertEqual(self.make_manager().get_unfinished_condition("subject1").next_trial_index, 1)
+
+  def test_finished_condition_loses_last_played(self):
+    subject_manager = self.make_manager()
+    condition = subject_manager.get_unfinished_condition("subject1")
+    for _ in range(5):
+      subject_manager.passed_trial("subject1", condition)
+    self.make_manager()
+    condition_info = self.read_condition("subject1", "high_ranking")
+    self.assertEqual(condition_info["next_trial_index"], 5)
+    self.assertNotIn("last_played", condition_info)
+    self.assertEqual(self.make_manager().get_unfinished_condition("subject1").condition_name, "low_ranking")
+
+  def test_records_for_removed_subjects_are_skipped(self):
+    journal = ProgressJournal(self.journal_path)
+    journal.append("gone", "high_ranking", {"next_trial_index": 2})
+    journal.close()
+    self.assertEqual(self.make_manager().get_unfinished_condition("subject1").next_trial_index, 0)
+
+class CompactionTest(JournalTestCase):
+
+  def test_journal_is_folded_into_subjects_json(self):
+    subject_manager = self.make_manager(total_trial_count=200)
+    subject_manager._journal_compact_every = 10
+    condition = subject_manager.get_unfinished_condition("subject1")
+    # 1 record for the condition start and 9 passed trials
+    for _ in range(9):
+      subject_manager.passed_trial("subject1", condition)
+    self.assertEqual(self.read_condition("subject1", "high_ranking")["next_trial_index"], 9)
+    self.assertEqual(getsize(self.journal_path), 0)
+    subject_manager.passed_trial("subject1", condition)
+    self.assertEqual(self.read_condition("subject1", "high_ranking")["next_trial_index"], 9)
+    self.assertEqual(self.make_manager(200).get_unfinished_condition("subject1").next_trial_index, 10)
+
+  def test_save_empties_the_journal(self):
+    subject_manager = self.make_manager()
+    condition = subject_manager.get_unfinished_condition("subject1")
+    subject_manager.passed_trial("subject1", condition)
+    self.assertGreater(getsize(self.journal_path), 0)
+    subject_manager.save()
+    self.assertEqual(getsize(self.journal_path), 0)
+    self.assertFalse(os.path.exists(self.subjects_file_path + ".tmp"))
+    self.assertEqual(self.read_condition("subject1", "high_ranking")["next_trial_index"], 1)
+
+if __name__ == "__main__":
+  unittest.main()
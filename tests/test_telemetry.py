@@ -0,0 +1,83 @@
+__author__ = 'Mohammed Hamdy'
+
+# python -m unittest discover tests
+
+import threading, time, unittest
+from lib.telemetry import TelemetryPublisher, TelemetrySubscriber, FrameDecoder, encode_frame
+
+def wait_until(condition, timeout=5.0):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+class FrameTest(unittest.TestCase):
+
+  def test_decoder_joins_split_frames(self):
+    data = encode_frame({"event": "touch", "slot": 3}) + encode_frame({"event": "choice"})
+    decoder = FrameDecoder()
+    messages = []
+    for index in range(len(data)):
+      messages.extend(decoder.feed(data[index:index + 1]))
+    self.assertEqual(messages, [{"event": "touch", "slot": 3}, {"event": "choice"}])
+
+class SubscriberTestCase(unittest.TestCase):
+  # runs a TelemetrySubscriber on an ephemeral port, collecting what it receives in `messages'
+
+  def setUp(self):
+    self.messages = []
+    self.start_subscriber("tcp:127.0.0.1:0")
+    self.address = "tcp:127.0.0.1:{}".format(self.subscriber.address[1])
+
+  def tearDown(self):
+    self.stop_subscriber()
+
+  def start_subscriber(self, address):
+    self.subscriber = TelemetrySubscriber(address, self.messages.append)
+    self.subscriber_thread = threading.Thread(target=self.subscriber.serve_forever, args=(0.05, ))
+    self.subscriber_thread.start()
+
+  def stop_subscriber(self):
+    if self.subscriber is None: return
+    self.subscriber.shutdown()
+    self.subscriber_thread.join()
+    self.subscriber = None
+
+class PublisherTest(SubscriberTestCase):
+
+  def test_delivers_events_of_several_booths_in_order(self):
+    publishers = [TelemetryPublisher(self.address, "booth{}".format(index), retry_interval=0.05) for index in range(3)]
+    for trial in range(100):
+      for publisher in publishers:
+        publisher.publish("choice", trial=trial, card="Risky")
+    self.assertTrue(wait_until(lambda: len(self.messages) == 300))
+    for publisher in publishers:
+      publisher.close()
+      self.assertEqual(publisher.get_stats()["sent"], 100)
+      self.assertEqual(publisher.dropped, 0)
+    for booth in ("booth0", "booth1", "booth2"):
+      booth_messages = [message for message in self.messages if message["booth"] == booth]
+      self.assertEqual([message["trial"] for message in booth_messages], list(range(100)))
+      self.assertTrue(all(message["event"] == "choice" and message["card"] == "Risky" for message in booth_messages))
+
+  def test_drops_oldest_events_without_a_subscriber(self):
+    self.stop_subscriber()
+    publisher = TelemetryPublisher(self.address, "booth", capacity=10, retry_interval=0.05)
+    start_time = time.perf_counter()
+    for index in range(100):
+      publisher.publish("touch", index=index)
+    publish_seconds = time.perf_counter() - start_time
+    time.sleep(0.1)
+    stats = publisher.get_stats()
+    self.assertEqual((stats["published"], stats["dropped"], stats["queued"]), (100, 90, 10))
+    self.assertFalse(stats["connected"])
+    # publishing never waits for the network
+    self.assertLess(publish_seconds, 0.5)
+    # the newest events are the ones sent once a subscriber shows up
+    self.start_subscriber(self.address)
+    self.assertTrue(wait_until(lambda: len(self.messages) == 10))
+    publisher.close()
+    self.assertEqual([message["index"] for message in self.messages], list(range(90, 100)))
+
+if __name__ == "__main__":
+  unittest.main()
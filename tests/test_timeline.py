@@ -0,0 +1,148 @@
+__author__ = 'Mohammed Hamdy'
+
+import shutil, tempfile, unittest
+from lib.payoff import PayoffSchedules
+from lib.session import TrialSession
+from lib.simulation import VirtualClock, MemoryTrialWriter, FakeDispenser, make_colony
+from lib.timeline import TrialTimeline
+from lib.timing import ChoiceTiming
+from lib.util import SubjectManager
+
+class DriftingClock(VirtualClock):
+  # wakes callbacks a fixed factor of their timeout early (factor < 1) or late (factor > 1)
+
+  def __init__(self, factor):
+    super(DriftingClock, self).__init__()
+    self.factor = factor
+    self.timeouts = []
+
+  def schedule_once(self, callback, timeout=0):
+    self.timeouts.append(timeout)
+    super(DriftingClock, self).schedule_once(callback, timeout * self.factor)
+
+class TrialTimelineTest(unittest.TestCase):
+
+  def make_timeline(self, clock):
+    self.done = []
+    return TrialTimeline(clock, lambda: clock.time, self.done.append)
+
+  def plan_trial(self, timeline, clock, ran):
+    timeline.start(0)
+    for name, offset in (("dispense", 0), ("dispense", 0.4), ("blank", 6), ("next_trial", 16)):
+      timeline.plan(name, offset, lambda name=name: ran.append((name, clock.time)))
+
+  def test_events_run_at_their_offsets_from_the_anchor(self):
+    clock, ran = VirtualClock(), []
+    clock.time = 100.
+    timeline = self.make_timeline(clock)
+    self.plan_trial(timeline, clock, ran)
+    # an event due now runs right away
+    self.assertEqual(ran, [("dispense", 100.)])
+    clock.run()
+    self.assertEqual([name for name, _ in ran], ["dispense", "dispense", "blank", "next_trial"])
+    self.assertEqual([(event.trial_index, event.name, event.planned) for event in self.done],
+                     [(0, "dispense", 0), (0, "dispense", 0.4), (0, "blank", 6), (0, "next_trial", 16)])
+    for (_, time), event in zip(ran, self.done):
+      self.assertAlmostEqual(time, 100 + event.planned)
+      self.assertAlmostEqual(event.actual, event.planned)
+    jitter = timeline.get_jitter_summary()
+    self.assertEqual(jitter["events"], 4)
+    self.assertAlmostEqual(jitter["max_abs_error_ms"], 0)
+
+  def test_early_wake_up_is_put_back_to_sleep(self):
+    clock, ran = DriftingClock(0.5), []
+    timeline = self.make_timeline(clock)
+    self.plan_trial(timeline, clock, ran)
+    clock.run()
+    self.assertEqual([name for name, _ in ran], ["dispense", "dispense", "blank", "next_trial"])
+    for event in self.done:
+      self.assertGreaterEqual(event.actual, event.planned - TrialTimeline._early_tolerance)
+    # every early wake up was followed by one for the rest of the wait
+    self.assertGreater(len(clock.timeouts), 3)
+    self.assertLess(timeline.get_jitter_summary()["max_abs_error_ms"], TrialTimeline._early_tolerance * 1000)
+
+  def test_late_wake_ups_do_not_add_up(self):
+    clock, ran = DriftingClock(1.01), []
+    timeline = self.make_timeline(clock)
+    self.plan_trial(timeline, clock, ran)
+    clock.run()
+    # every event is scheduled from the anchor, so each is 1% of its own offset late, not of the offsets before it
+    for event in self.done:
+      self.assertAlmostEqual(event.error, event.planned * 0.01)
+    self.assertEqual(clock.timeouts, [0.4, 6, 16])
+
+  def test_events_of_a_later_trial_use_its_own_anchor(self):
+    clock = VirtualClock()
+    timeline = self.make_timeline(clock)
+    timeline.start(0)
+    timeline.plan("blank", 6, lambda: None)
+    clock.run()
+    clock.time += 2.5
+    timeline.start(1)
+    timeline.plan("blank", 6, lambda: None)
+    clock.run()
+    self.assertEqual(clock.time, 14.5)
+    self.assertEqual([(event.trial_index, event.actual) for event in self.done], [(0, 6.), (1, 6.)])
+
+class ChoosingScreens(object):
+  # picks the left card in every trial, a second after it shows
+
+  def __init__(self, clock):
+    self._clock = clock
+    self.session = None
+
+  def show_screen(self, name):
+    if name == "start_trial":
+      self._clock.schedule_once(lambda elapsed: self.session.show_trial())
+    elif name == "trial":
+      self._clock.schedule_once(lambda elapsed: self.session.left_card_chosen(ChoiceTiming(0, 1, 1, 0)), 1)
+
+  def collect_trial_data(self, trial_data):
+    pass
+
+class SessionTimelineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def run_trial(self, count_pellets):
+    # returns {event name: [planned offsets]} of a single trial paying `count_pellets'
+    subjects_file_path, video_dir = make_colony(self.directory, 1)
+    clock, events = VirtualClock(), []
+    screens = ChoosingScreens(clock)
+    screens.session = session = TrialSession(SubjectManager(1, subjects_file_path, video_dir), PayoffSchedules(),
+                                             FakeDispenser(), MemoryTrialWriter(), clock, screens, self.directory, 1,
+                                             lambda: clock.time, events.append)
+    session.start("subject1")
+    session._payoff_risky = [count_pellets]
+    session.begin()
+    clock.run()
+    offsets = {}
+    for event in events:
+      offsets.setdefault(event.name, []).append(event.planned)
+    return offsets
+
+  def test_blank_follows_the_reward_period(self):
+    offsets = self.run_trial(2)
+    self.assertEqual(offsets["dispense"], [0, 0.4])
+    self.assertEqual(offsets["blank"], [6])
+    self.assertEqual(offsets["next_trial"], [16])
+
+  def test_blank_moves_after_the_last_pellet(self):
+    # 20 pellets take 0.4 * 20 = 8 seconds, more than the 6 second reward period
+    offsets = self.run_trial(20)
+    self.assertEqual(len(offsets["dispense"]), 20)
+    self.assertAlmostEqual(offsets["dispense"][-1], 7.6)
+    self.assertAlmostEqual(offsets["blank"][0], 8)
+    self.assertAlmostEqual(offsets["next_trial"][0], 18)
+
+  def test_no_pellets_still_waits_the_reward_period(self):
+    offsets = self.run_trial(0)
+    self.assertNotIn("dispense", offsets)
+    self.assertEqual((offsets["blank"], offsets["next_trial"]), ([6], [16]))
+
+if __name__ == "__main__":
+  unittest.main()
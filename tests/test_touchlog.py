@@ -0,0 +1,69 @@
+__author__ = 'Mohammed Hamdy'
+
+import shutil, tempfile, unittest
+from os.path import join, getsize
+from lib.touchlog import TouchRecorder, load_touch_stream, record_size, SLOT_VIDEO
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+@unittest.skipIf(numpy is None, "load_touch_stream needs numpy")
+class TouchRecorderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    self.path = join(self.directory, "touches.bin")
+    # flushed by the test only
+    self.recorder = TouchRecorder(self.path, capacity=8, flush_interval=3600)
+
+  def tearDown(self):
+    self.recorder.close()
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def record(self, first, last):
+    for index in range(first, last):
+      self.recorder.trial_index = index // 4
+      self.recorder.record(index * 0.5, index * 10., index * 20., index % 9)
+
+  def assert_records(self, indexes):
+    touches = load_touch_stream(self.path)
+    self.assertEqual(touches["timestamp"].tolist(), [index * 0.5 for index in indexes])
+    self.assertEqual(touches["x"].tolist(), [index * 10. for index in indexes])
+    self.assertEqual(touches["y"].tolist(), [index * 20. for index in indexes])
+    self.assertEqual(touches["slot"].tolist(), [index % 9 for index in indexes])
+    self.assertEqual(touches["trial_index"].tolist(), [index // 4 for index in indexes])
+
+  def test_records_wrap_around_the_buffer_in_order(self):
+    self.record(0, 6)
+    self.recorder._flush()
+    # these wrap past the end of the buffer
+    self.record(6, 13)
+    self.recorder.close()
+    self.assertEqual(self.recorder.overrun_count, 0)
+    self.assertEqual(getsize(self.path), 13 * record_size)
+    self.assert_records(range(13))
+
+  def test_overrun_keeps_the_newest_records(self):
+    self.record(0, 3)
+    self.recorder._flush()
+    self.record(3, 23)
+    self.recorder.close()
+    # 20 records since the last flush, the buffer holds 8 of them
+    self.assertEqual(self.recorder.overrun_count, 12)
+    self.assert_records(list(range(3)) + list(range(15, 23)))
+
+  def test_sessions_append_to_the_stream(self):
+    self.record(0, 2)
+    self.recorder.close()
+    self.recorder = TouchRecorder(self.path, capacity=8, flush_interval=3600)
+    self.recorder.trial_index = 0
+    self.recorder.record(1.5, 1., 2., SLOT_VIDEO)
+    self.recorder.close()
+    touches = load_touch_stream(self.path)
+    self.assertEqual(touches["timestamp"].tolist(), [0., 0.5, 1.5])
+    self.assertEqual(touches["slot"].tolist()[-1], SLOT_VIDEO)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,100 @@
+__author__ = 'Mohammed Hamdy'
+
+import csv, os, shutil, tempfile, time, unittest
+from os.path import join, exists
+from lib.trialwriter import TrialDataWriter
+
+def read_rows(path):
+  with open(path, 'r', newline='') as stats_reader:
+    return list(csv.reader(stats_reader))
+
+def wait_until(condition, timeout=5.0):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+class TrialWriterTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="primate_test_")
+    self.writer = TrialDataWriter()
+    self.writer.retry_interval = 0.05
+
+  def tearDown(self):
+    self.writer.close()
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+class RetryTest(TrialWriterTestCase):
+
+  def test_rows_wait_until_their_file_can_be_written(self):
+    # the file's directory is missing, like a drive that isn't mounted yet
+    stats_dir = join(self.directory, "stats")
+    path, other_path = join(stats_dir, "stats_subject1.csv"), join(self.directory, "stats_subject2.csv")
+    self.writer.write_row(path, [1, "Risky"])
+    self.writer.write_row(path, [2, "Safe"])
+    self.writer.write_row(other_path, [1, "Safe"])
+    time.sleep(0.2)
+    # rows queued after the failing one wait behind it
+    self.assertFalse(exists(other_path))
+    self.assertTrue(self.writer._thread.is_alive())
+    os.mkdir(stats_dir)
+    self.assertTrue(wait_until(lambda: exists(other_path)))
+    self.writer.close()
+    self.assertEqual(read_rows(path), [["1", "Risky"], ["2", "Safe"]])
+    self.assertEqual(read_rows(other_path), [["1", "Safe"]])
+
+  def test_close_drops_rows_that_still_fail(self):
+    path = join(self.directory, "missing", "stats_subject1.csv")
+    self.writer.write_row(path, [1, "Risky"])
+    start_time = time.time()
+    self.writer.close()
+    self.assertLess(time.time() - start_time, 2)
+    self.assertFalse(exists(path))
+
+  def test_rows_the_csv_module_refuses_are_dropped_alone(self):
+    path = join(self.directory, "stats_subject1.csv")
+    self.writer.write_row(path, 5) # not a sequence
+    self.writer.write_row(path, [1, "Risky"])
+    self.writer.close()
+    self.assertEqual(read_rows(path), [["1", "Risky"]])
+
+class HeaderUpgradeTest(TrialWriterTestCase):
+
+  old_header = ["Trial Index", "Card Selected"]
+  header = ["Trial Index", "Card Selected", "Touch Delay (ms)"]
+
+  def write_old_file(self, path):
+    with open(path, 'w', newline='') as stats_writer:
+      csv.writer(stats_writer).writerows([self.old_header, [1, "Risky"], [2, "Safe"]])
+
+  def test_short_header_is_replaced_and_rows_kept(self):
+    path = join(self.directory, "stats_subject1.csv")
+    self.write_old_file(path)
+    self.writer.ensure_header(path, self.header)
+    self.writer.write_row(path, [3, "Risky", 12.5])
+    self.writer.close()
+    self.assertEqual(read_rows(path), [self.header, ["1", "Risky"], ["2", "Safe"], ["3", "Risky", "12.5"]])
+
+  def test_file_open_for_rows_is_reopened_after_the_upgrade(self):
+    path = join(self.directory, "stats_subject1.csv")
+    self.write_old_file(path)
+    # the writer holds the file open from this row on
+    self.writer.write_row(path, [3, "Risky"])
+    self.writer.ensure_header(path, self.header)
+    self.writer.write_row(path, [4, "Safe", 8.0])
+    self.writer.close()
+    self.assertEqual(read_rows(path), [self.header, ["1", "Risky"], ["2", "Safe"], ["3", "Risky"], ["4", "Safe", "8.0"]])
+
+  def test_full_header_and_missing_file_are_left_alone(self):
+    path, missing_path = join(self.directory, "stats_subject1.csv"), join(self.directory, "stats_subject2.csv")
+    with open(path, 'w', newline='') as stats_writer:
+      csv.writer(stats_writer).writerows([self.header, [1, "Risky", 10]])
+    self.writer.ensure_header(path, self.old_header)
+    self.writer.ensure_header(missing_path, self.header)
+    self.writer.close()
+    self.assertEqual(read_rows(path), [self.header, ["1", "Risky", "10"]])
+    self.assertFalse(exists(missing_path))
+
+if __name__ == "__main__":
+  unittest.main()
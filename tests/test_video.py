@@ -0,0 +1,70 @@
+__author__ = 'Mohammed Hamdy'
+
+import unittest
+from unittest import mock
+from ui import video as video_module
+from ui.video import ConditionVideoManager
+
+class FakeVideo(object):
+  # the parts of kivy's Video the manager uses
+
+  def __init__(self):
+    self.source = ""
+    self.state = "stop"
+    self._on_position = None
+
+  def bind(self, position):
+    self._on_position = position
+
+  def show_frame(self):
+    self._on_position(self, 0)
+
+class ConditionVideoManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.now = 0.
+    patcher = mock.patch.object(video_module.time, "perf_counter", lambda: self.now)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.video = FakeVideo()
+    self.manager = ConditionVideoManager(self.video)
+    self.manager.load("high_ranking.mp4")
+
+  def play(self, intervals):
+    for interval in intervals:
+      self.now += interval
+      self.video.show_frame()
+
+  def run_trial(self, intervals):
+    self.manager.begin_trial(self.now)
+    self.play(intervals)
+    return self.manager.end_trial()
+
+  def test_frame_interval_follows_the_video(self):
+    self.play([0.04] * 40)
+    self.assertAlmostEqual(self.manager.get_frame_interval(), 0.04)
+    # frames of a 25 fps video are 40 ms apart, which a 30 fps interval would count as late
+    stats = self.run_trial([0.04] * 100)
+    self.assertAlmostEqual(stats.first_frame_latency, 0.04)
+    self.assertEqual((stats.late_frames, stats.dropped_frames), (0, 0))
+
+  def test_frame_a_display_frame_late_is_on_time(self):
+    self.play([1 / 30.] * 40)
+    stats = self.run_trial([1 / 30.] * 5 + [1 / 30. * 1.5 + 1 / 60. - 0.001] + [1 / 30.] * 5)
+    self.assertEqual((stats.late_frames, stats.dropped_frames), (0, 0))
+
+  def test_late_frames_count_the_frames_they_skipped(self):
+    self.play([0.04] * 40)
+    stats = self.run_trial([0.04] * 5 + [0.12] + [0.04] * 5 + [0.2])
+    self.assertEqual((stats.late_frames, stats.dropped_frames), (2, 2 + 4))
+
+  def test_new_video_measures_its_own_frame_rate(self):
+    self.play([0.04] * 40)
+    self.manager.load("low_ranking.mp4")
+    # the default interval until enough frames came
+    self.assertAlmostEqual(self.manager.get_frame_interval(), 1 / 30.)
+    self.play([0.02] * 40)
+    self.assertAlmostEqual(self.manager.get_frame_interval(), 0.02)
+
+if __name__ == "__main__":
+  unittest.main()
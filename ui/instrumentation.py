@@ -0,0 +1,44 @@
+__author__ = 'Mohammed Hamdy'
+
+from kivy.clock import Clock
+from kivy.core.window import Window
+from lib import timing
+
+class UiInstrumentation(object):
+  """
+  Feeds a MetricsRegistry with what the kivy loop is doing:
+    frame_seconds: time between frames
+    screen_transition_seconds{screen}: from changing the current screen till the next frame is drawn
+  and exports the registry to a Prometheus text file every `export_interval' seconds.
+  """
+
+  def __init__(self, registry, screen_manager, export_path, export_interval=10):
+    self._registry = registry
+    self._export_path = export_path
+    self._frame_histogram = registry.histogram("frame_seconds", "Time between frames")
+    self._last_frame_time = None
+    self._transition_screen = None
+    self._transition_start_time = None
+    Clock.schedule_interval(self._on_frame, 0)
+    Clock.schedule_interval(self.export, export_interval)
+    screen_manager.bind(current=self._on_screen_changed)
+    Window.bind(on_flip=self._on_window_flip)
+
+  def export(self, *args):
+    self._registry.export_prometheus(self._export_path)
+
+  def _on_frame(self, elapsed):
+    frame_time = timing.now()
+    if self._last_frame_time is not None:
+      self._frame_histogram.observe(frame_time - self._last_frame_time)
+    self._last_frame_time = frame_time
+
+  def _on_screen_changed(self, screen_manager, screen_name):
+    self._transition_screen = screen_name
+    self._transition_start_time = timing.now()
+
+  def _on_window_flip(self, window):
+    if self._transition_screen is None: return
+    self._registry.histogram("screen_transition_seconds", "From switching screens till the next drawn frame",
+                             screen=self._transition_screen).observe(timing.now() - self._transition_start_time)
+    self._transition_screen = None
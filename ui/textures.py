@@ -0,0 +1,33 @@
+__author__ = 'Mohammed Hamdy'
+
+import time
+from kivy.core.image import Image as CoreImage
+from kivy.logger import Logger
+
+class TextureCache(object):
+  """
+  Decodes images into GPU textures once, so trial screens can swap textures instead of reloading sources.
+    Needs the window (and its GL context) to exist, so preload from `build' or later.
+    Textures are keyed by the original image path, `get_path' gives the file to decode instead, like a prepared one.
+    When that file changes, like once assets are prepared, the image is decoded again from the new file.
+  """
+
+  def __init__(self, get_path=None):
+    self._textures = {} # original image path -> (decoded path, texture)
+    self._get_path = get_path or (lambda image_path: image_path)
+
+  def preload(self, image_paths):
+    start_time = time.perf_counter()
+    for image_path in image_paths:
+      self.get(image_path)
+    Logger.info("TextureCache: preloaded {} textures in {:.1f} ms"
+                .format(len(self._textures), (time.perf_counter() - start_time) * 1000))
+
+  def get(self, image_path):
+    path = self._get_path(image_path)
+    decoded_path, texture = self._textures.get(image_path, (None, None))
+    if decoded_path != path:
+      # images not preloaded are still cached after their first use
+      texture = CoreImage(path).texture
+      self._textures[image_path] = (path, texture)
+    return texture
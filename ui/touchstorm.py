@@ -0,0 +1,295 @@
+__author__ = 'Mohammed Hamdy'
+
+# drives a real TrialScreen, built from ui/screens.kv in an offscreen window, with bursts of synthetic touches and checks
+# what it made of them: touch dispatch time, card choices missed or counted twice, and the get_touches() counters.
+# usage: python -m ui.touchstorm [--trials 50] [--rate 40] [--pattern storm] [--seed 0] [--report touchstorm.json]
+#
+# the same seed replays the same touches, so reports of two versions can be compared.
+# run it from the repository root, like main.py.
+#
+# kivy 1.9.1 can't hide its window, so the window is made by SDL2's offscreen video driver, which renders through EGL
+# and needs no display. it's in SDL2 2.0.10 and later; with an older SDL2, or to watch the storm, set SDL_VIDEODRIVER
+# to the platform's driver (x11, windows) and it runs in a normal window
+
+import os, sys
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+from kivy.config import Config
+Config.set("graphics", "width", "1920")
+Config.set("graphics", "height", "1080")
+
+import argparse, json, math, random, shutil, tempfile
+from os.path import dirname, join, abspath
+from kivy.app import App
+from kivy.base import EventLoop
+from kivy.clock import Clock
+from kivy.input.motionevent import MotionEvent
+from kivy.lang import Builder
+from kivy.uix.screenmanager import ScreenManager, Screen, NoTransition
+
+_root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, _root_dir)
+from main import TrialScreen
+from lib import timing
+from lib.util import Condition, get_trial_image_paths
+from ui.textures import TextureCache
+
+class SyntheticTouch(MotionEvent):
+
+  def depack(self, args):
+    self.is_touch = True
+    self.sx, self.sy = args
+    self.profile = ["pos"]
+    super(SyntheticTouch, self).depack(args)
+
+# touch patterns. a pattern returns the touches of a trial as (seconds after the trial started, x, y, hold seconds),
+# x and y in window pixels. `targets' maps "video", "background", "left_card" and "right_card" to rectangles
+
+def _point_in(rng, rectangle, margin=2):
+  left, bottom, right, top = rectangle
+  return rng.uniform(left + margin, right - margin), rng.uniform(bottom + margin, top - margin)
+
+def storm(rng, targets, rate, duration=2.0, palm_probability=0.15):
+  # touches all over the screen at `rate' per second, some of them palms: 4 to 6 touches at once close together.
+  # one of the cards is touched somewhere in the storm, and both cards now and then after it
+  touches = []
+  offset = rng.expovariate(rate)
+  rectangles = [rectangle for rectangles in targets.values() for rectangle in rectangles]
+  while offset < duration:
+    x, y = _point_in(rng, rng.choice(rectangles))
+    if rng.random() < palm_probability:
+      for _ in range(rng.randint(4, 6)):
+        touches.append((offset, x + rng.uniform(-40, 40), y + rng.uniform(-40, 40), rng.uniform(0.1, 0.4)))
+    else:
+      touches.append((offset, x, y, rng.uniform(0.03, 0.15)))
+    offset += rng.expovariate(rate)
+  choice_offset = rng.uniform(0, duration)
+  card = rng.choice(["left_card", "right_card"])
+  touches.append((choice_offset, ) + _point_in(rng, targets[card][0]) + (0.08, ))
+  return sorted(touches)
+
+def card_race(rng, targets, rate, duration=2.0):
+  # both cards touched within a frame, several times, over a light storm. only the first may count
+  touches = storm(rng, targets, rate / 4., duration, palm_probability=0)
+  for _ in range(3):
+    offset = rng.uniform(0, duration)
+    for card in rng.sample(["left_card", "right_card"], 2):
+      touches.append((offset, ) + _point_in(rng, targets[card][0]) + (0.05, ))
+  return sorted(touches)
+
+def double_tap(rng, targets, rate, duration=1.0):
+  # quick repeated taps on one card, like a subject hammering its choice
+  card = rng.choice(["left_card", "right_card"])
+  offset = rng.uniform(0, duration / 2)
+  return [(offset + index * 0.03, ) + _point_in(rng, targets[card][0]) + (0.02, ) for index in range(8)]
+
+patterns = {"storm": storm, "card_race": card_race, "double_tap": double_tap}
+
+class TrialCheck(object):
+  # what a trial's touches should have done, worked out from the touch positions alone
+
+  def __init__(self):
+    self.background_touches = 0
+    self.video_touches = 0
+    self.choice = None
+
+  def add(self, role):
+    if role == "video":
+      self.video_touches += 1
+    elif role == "background":
+      self.background_touches += 1
+    elif role in ("left_card", "right_card") and self.choice is None:
+      # the cards are disabled once one is chosen, so later card touches count for nothing
+      self.choice = role
+
+def percentile(sorted_samples, q):
+  # nearest rank, so it's always one of the samples
+  return sorted_samples[max(0, int(math.ceil(q * len(sorted_samples))) - 1)]
+
+class TouchStormReport(object):
+
+  def __init__(self, pattern, rate, seed):
+    self.pattern = pattern
+    self.rate = rate
+    self.seed = seed
+    self.trials = 0
+    self.touches = 0
+    # seconds each touch took to dispatch. a dispatch is about 0.1 ms, far below the 1 ms of the metrics histograms'
+    # first bucket, so every sample is kept and percentiles are exact
+    self.dispatch = []
+    self.missed_choices = 0
+    self.double_choices = 0
+    self.wrong_choices = 0
+    self.background_miscounts = 0
+    self.video_miscounts = 0
+
+  @property
+  def errors(self):
+    return (self.missed_choices + self.double_choices + self.wrong_choices + self.background_miscounts +
+            self.video_miscounts)
+
+  def as_dict(self):
+    return {"pattern": self.pattern, "rate": self.rate, "seed": self.seed, "trials": self.trials,
+            "touches": self.touches, "dispatch": self.get_dispatch_summary(), "missed_choices": self.missed_choices,
+            "double_choices": self.double_choices, "wrong_choices": self.wrong_choices,
+            "background_miscounts": self.background_miscounts, "video_miscounts": self.video_miscounts}
+
+  def get_dispatch_summary(self):
+    if not self.dispatch:
+      return {"count": 0}
+    samples = sorted(self.dispatch)
+    return {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000, "max_ms": samples[-1] * 1000,
+            "p50_ms": percentile(samples, 0.5) * 1000, "p90_ms": percentile(samples, 0.9) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000}
+
+  def __str__(self):
+    dispatch = self.get_dispatch_summary()
+    return ("{} trials of '{}' at {:.0f} touches/s (seed {}), {} touches\n"
+            "dispatch: mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms\n"
+            "choices: {} missed, {} double, {} wrong card\n"
+            "get_touches(): {} trials with wrong background counts, {} with wrong video counts"
+            .format(self.trials, self.pattern, self.rate, self.seed, self.touches, dispatch.get("mean_ms", 0),
+                    dispatch.get("p50_ms", 0), dispatch.get("p99_ms", 0), dispatch.get("max_ms", 0),
+                    self.missed_choices, self.double_choices, self.wrong_choices, self.background_miscounts,
+                    self.video_miscounts))
+
+class TouchStormApp(App):
+  """
+  Runs `trial_count' trials of a TrialScreen, each one a touch pattern played in real time frame by frame.
+    Touches go through kivy's event loop like ones from a touch screen do. Between trials a blank screen shows,
+    so the trial screen goes through on_pre_enter and on_enter as in a session.
+  """
+
+  def __init__(self, pattern, trial_count, rate, seed, **kwargs):
+    super(TouchStormApp, self).__init__(**kwargs)
+    self._pattern = patterns[pattern]
+    self._trial_count = trial_count
+    self._rate = rate
+    self._rng = random.Random(seed)
+    self.report = TouchStormReport(pattern, rate, seed)
+    self._touch_id = 0
+    self._screen_trial = None
+    self._pending = [] # (seconds after trial start, "begin" or "end", touch id, normalized position, role)
+    self._held = {} # touch id -> touch, from its begin till its end
+    self._trial_start_time = None
+    self._check = None
+    self._choices = []
+    self._video_dir = None
+
+  def build(self):
+    Builder.load_file(join(_root_dir, "ui", "screens.kv"))
+    texture_cache = TextureCache()
+    texture_cache.preload(get_trial_image_paths())
+    self._screen_trial = TrialScreen(texture_cache, lambda path: path, name="trial")
+    self._screen_trial.bind(on_left_card_chosen=lambda screen, choice_timing: self._choices.append("left_card"),
+                            on_right_card_chosen=lambda screen, choice_timing: self._choices.append("right_card"))
+    # the touches don't depend on what the video shows, so an empty one stands in for the lab's condition videos
+    self._video_dir = tempfile.mkdtemp(prefix="primate_touchstorm_")
+    video_path = join(self._video_dir, "high_ranking.mp4")
+    open(video_path, 'w').close()
+    self._screen_trial.set_condition(Condition(video_path))
+    manager_screen = ScreenManager(transition=NoTransition())
+    manager_screen.add_widget(Screen(name="blank_screen"))
+    manager_screen.add_widget(self._screen_trial)
+    manager_screen.current = "blank_screen"
+    return manager_screen
+
+  def on_start(self):
+    Clock.schedule_once(self._start_trial, 0.1)
+
+  def on_stop(self):
+    shutil.rmtree(self._video_dir, ignore_errors=True)
+
+  def _start_trial(self, *args):
+    self.root.current = "trial"
+    # the touches start once the trial screen is drawn
+    Clock.schedule_once(self._play_trial, 0)
+
+  def _play_trial(self, *args):
+    targets = self._get_targets()
+    self._pending = []
+    for offset, x, y, hold in self._pattern(self._rng, targets, self._rate):
+      self._touch_id += 1
+      position, role = (x / self.root.width, y / self.root.height), self._get_role(targets, x, y)
+      self._pending.append((offset, "begin", self._touch_id, position, role))
+      self._pending.append((offset + hold, "end", self._touch_id, position, role))
+    self._pending.sort(key=lambda event: event[0])
+    self._check = TrialCheck()
+    self._choices = []
+    self._trial_start_time = timing.now()
+    Clock.schedule_interval(self._dispatch_due_touches, 0)
+
+  def _dispatch_due_touches(self, *args):
+    elapsed = timing.now() - self._trial_start_time
+    while self._pending and self._pending[0][0] <= elapsed:
+      _, event_type, touch_id, position, role = self._pending.pop(0)
+      if event_type == "begin":
+        # made when it's due, so its time_start is as fresh as one from an input provider
+        touch = self._held[touch_id] = SyntheticTouch("touchstorm", touch_id, position)
+        self._check.add(role)
+        start_time = timing.now()
+        EventLoop.post_dispatch_input("begin", touch)
+        self.report.dispatch.append(timing.now() - start_time)
+        self.report.touches += 1
+      else:
+        touch = self._held.pop(touch_id)
+        touch.update_time_end()
+        EventLoop.post_dispatch_input("end", touch)
+    if self._pending:
+      return True
+    self._finish_trial()
+    return False
+
+  def _finish_trial(self):
+    report, check = self.report, self._check
+    report.trials += 1
+    if not self._choices:
+      report.missed_choices += 1
+    elif len(self._choices) > 1:
+      report.double_choices += 1
+    elif self._choices[0] != check.choice:
+      report.wrong_choices += 1
+    background_touches, video_touches = self._screen_trial.get_touches()
+    report.background_miscounts += background_touches != check.background_touches
+    report.video_miscounts += video_touches != check.video_touches
+    self.root.current = "blank_screen"
+    if report.trials < self._trial_count:
+      Clock.schedule_once(self._start_trial, 0)
+    else:
+      self.stop()
+
+  def _get_targets(self):
+    # rectangles in window coordinates of what a touch can hit this trial
+    screen_trial = self._screen_trial
+    targets = {"video": [], "background": [], "left_card": [], "right_card": []}
+    widget_roles = [(screen_trial.ids.video_condition, "video"), (screen_trial.ids.background_left, "background"),
+                    (screen_trial.ids.background_right, "background")]
+    widget_roles.extend(screen_trial.get_slot_roles().items())
+    for widget, role in widget_roles:
+      left, bottom = widget.to_window(widget.x, widget.y)
+      right, top = widget.to_window(widget.right, widget.top)
+      targets[role].append((left, bottom, right, top))
+    return targets
+
+  def _get_role(self, targets, x, y):
+    for role, rectangles in targets.items():
+      for left, bottom, right, top in rectangles:
+        if left <= x <= right and bottom <= y <= top:
+          return role
+    return None # between widgets or off the screen
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Hammer a real TrialScreen with synthetic touches")
+  parser.add_argument("--trials", type=int, default=50)
+  parser.add_argument("--rate", type=float, default=40., help="touches per second")
+  parser.add_argument("--pattern", choices=sorted(patterns), default="storm")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--report", help="also write the report as json to this file")
+  args = parser.parse_args()
+  app = TouchStormApp(args.pattern, args.trials, args.rate, args.seed)
+  app.run()
+  print(app.report)
+  if args.report:
+    with open(args.report, 'w', newline='') as report_writer:
+      json.dump(app.report.as_dict(), report_writer, indent=2)
+  sys.exit(1 if app.report.errors else 0)
@@ -0,0 +1,75 @@
+__author__ = 'Mohammed Hamdy'
+
+import time
+from collections import deque
+
+class VideoTrialStats(object):
+
+  def __init__(self, first_frame_latency=None, late_frames=0, dropped_frames=0):
+    self.first_frame_latency = first_frame_latency # seconds from trial start till the first new frame, None if no frame came
+    self.late_frames = late_frames # frames that came later than 1.5 frame intervals and a display frame after the previous one
+    self.dropped_frames = dropped_frames # frame slots skipped by late frames
+
+class ConditionVideoManager(object):
+  """
+  Keeps the condition video playing between trials and measures its frames during each trial.
+    The video is loaded and started as soon as the condition is known, and keeps decoding through the start trial
+    and blank screens, so trials don't wait for the video to open. Looping is left to the video's `eos' option.
+    The frame interval is the median of the recent intervals between frames, so it follows the video's frame rate.
+    `frame_interval' is only used until enough frames came in.
+  """
+
+  # frame intervals the median is taken over
+  _interval_window = 31
+  # a frame only shows at the next buffer swap, so it can come up to a display frame late on time
+  _display_frame_interval = 1 / 60.
+
+  def __init__(self, video, frame_interval=1 / 30.):
+    self._video = video
+    self._frame_interval = frame_interval
+    self._intervals = deque(maxlen=self._interval_window)
+    self._in_trial = False
+    self._trial_start_time = None
+    self._last_frame_time = None
+    self._stats = VideoTrialStats()
+    # the video widget updates its position with every decoded frame
+    video.bind(position=self._on_video_frame)
+
+  def load(self, source):
+    if self._video.source != source:
+      self._video.source = source
+      # another video can have another frame rate
+      self._intervals.clear()
+      self._last_frame_time = None
+    self._video.state = "play"
+
+  def begin_trial(self, start_time=None):
+    self._trial_start_time = time.perf_counter() if start_time is None else start_time
+    self._stats = VideoTrialStats()
+    self._in_trial = True
+    if self._video.state != "play":
+      self._video.state = "play"
+
+  def end_trial(self):
+    self._in_trial = False
+    return self._stats
+
+  def get_frame_interval(self):
+    if len(self._intervals) < self._intervals.maxlen // 2:
+      return self._frame_interval
+    intervals = sorted(self._intervals)
+    return intervals[len(intervals) // 2]
+
+  def _on_video_frame(self, video, position):
+    frame_time = time.perf_counter()
+    if self._last_frame_time is not None:
+      interval = frame_time - self._last_frame_time
+      frame_interval = self.get_frame_interval()
+      if self._in_trial and self._stats.first_frame_latency is not None and \
+          interval > 1.5 * frame_interval + self._display_frame_interval:
+        self._stats.late_frames += 1
+        self._stats.dropped_frames += max(0, int(round(interval / frame_interval)) - 1)
+      self._intervals.append(interval)
+    if self._in_trial and self._stats.first_frame_latency is None:
+      self._stats.first_frame_latency = frame_time - self._trial_start_time
+    self._last_frame_time = frame_time